@@ -20,11 +20,11 @@ This file is part of yata-bot.
 # import standard modules
 import json
 import os
-import aiohttp
 import traceback
 import html
 import logging
 import asyncio
+import time
 
 # import discord modules
 import discord
@@ -35,18 +35,108 @@ from discord.utils import get
 # import bot functions and classes
 # from includes.yata_db import get_member_key
 from inc.yata_db import set_configuration
+from inc.yata_db import update_configuration
 from inc.yata_db import get_yata_user
+from inc.yata_db import init_pool
+from inc.yata_db import close_pool
+from inc.torn_api import TornAPI
+from inc.key_pool import MasterKeyPool
+from inc.faction_snapshots import FactionSnapshots
+from inc.live_message import LiveMessage
+from inc.dm_queue import DMQueue
+from inc.cache import TTLCache
+from inc.configurations import ConfigurationStore
 from inc.handy import *
 
 
 # Child class of Bot with extra configuration variables
 class YataBot(Bot):
-    def __init__(self, configurations=None, main_server_id=0, bot_id=0, github_token=None, **args):
+    def __init__(self, configurations=None, main_server_id=0, bot_id=0, github_token=None, torn_api=None, db_pool=(1, 10), identity_ttl=(60, 300), config_flush=5, notify_worker=False, **args):
         Bot.__init__(self, **args)
-        self.configurations = configurations
+        self.configurations = ConfigurationStore({} if configurations is None else configurations)
         self.bot_id = int(bot_id)
         self.github_token = github_token
         self.main_server_id = int(main_server_id)
+        self.torn_api = TornAPI() if torn_api is None else torn_api
+        self.db_pool = db_pool
+        self.master_keys = MasterKeyPool(self.torn_api)
+        self.factions = FactionSnapshots(self.torn_api)
+
+        # status messages edited in place
+        self.live = LiveMessage(self)
+
+        # direct messages coalesced per user
+        self.dms = DMQueue()
+
+        # discord id -> (0, torn id, name, key) or (-3, None) not verified or (-4, torn id) not on YATA
+        # the verified identities are short lived: a key changed or revoked on YATA is picked up within the ttl
+        self.identity_ttl = (int(identity_ttl[0]), int(identity_ttl[1]))
+        self.identities = TTLCache(ttl=self.identity_ttl[0], size=20000)
+
+        # write behind of the configurations (seconds between two writes)
+        self.config_flush = int(config_flush)
+        self.config_flusher = None
+
+        # notifier worker process: no guild lifecycle handling and no configuration writes (done by the main process)
+        self.notify_worker = notify_worker
+
+        # startup timings: (start time, [(phase, seconds), ...]) set by the launcher
+        self.startup = None
+
+    async def start(self, *args, **kwargs):
+        # open the database pool and the Torn API session before connecting to discord
+        await init_pool(min_size=self.db_pool[0], max_size=self.db_pool[1])
+        await self.torn_api.open()
+        if not self.notify_worker:
+            self.config_flusher = asyncio.get_event_loop().create_task(self.flush_configurations_loop())
+        await Bot.start(self, *args, **kwargs)
+
+    async def close(self):
+        # write the pending configuration changes before closing the pool
+        if self.config_flusher is not None:
+            self.config_flusher.cancel()
+            self.config_flusher = None
+        if not self.notify_worker:
+            await self.flush_configurations()
+
+        self.live.close()
+        await self.torn_api.close()
+        await close_pool()
+        await Bot.close(self)
+
+    async def flush_configurations(self):
+        """ writes the configurations marked as dirty
+            one statement per guild, only with the modules that changed
+        """
+        for guild_id in list(self.configurations.dirty):
+            if guild_id not in self.configurations.dirty:
+                continue
+            modules = self.configurations.dirty.pop(guild_id)
+            configuration = self.configurations.get(guild_id, {})
+            guild = self.get_guild(guild_id)
+            guild_name = configuration.get("admin", {}).get("guild_name", "") if guild is None else guild.name
+
+            try:
+                if modules is None:
+                    await set_configuration(self.bot_id, guild_id, guild_name, configuration)
+                else:
+                    changed = {m: configuration[m] for m in modules if m in configuration}
+                    deleted = [m for m in modules if m not in configuration]
+                    await update_configuration(self.bot_id, guild_id, guild_name, changed, deleted, configuration)
+                logging.debug(f'[flush_configurations] {guild_name} [{guild_id}]: {"all" if modules is None else ", ".join(modules)}')
+
+            except BaseException as e:
+                # keep the changes for the next flush
+                for module in [None] if modules is None else modules:
+                    self.configurations.mark_dirty(guild_id, module)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                logging.error(f'[flush_configurations] {guild_name} [{guild_id}]: {hide_key(e)}')
+
+    async def flush_configurations_loop(self):
+        while True:
+            await asyncio.sleep(self.config_flush)
+            await self.flush_configurations()
 
     async def discord_to_torn(self, member, key):
         """ get a torn id form discord id
@@ -54,10 +144,7 @@ class YataBot(Bot):
             return -1, error: api error
             return -2, None: not verified on discord
         """
-        url = f"https://api.torn.com/user/{member.id}?selections=discord&key={key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                req = await r.json()
+        req = await self.torn_api.get("user", member.id, "discord", key)
 
         if 'error' in req:
             # logging.info(f'[DISCORD TO TORN] api error "{key}": {req["error"]["error"]}')
@@ -71,25 +158,37 @@ class YataBot(Bot):
             return int(req['discord'].get("userID")), None
 
     async def get_master_key(self, guild):
-        """ gets a random master key from configuration
-            return 0, id, Name, Key: All good
-            return -1, None, None, None: no key given
+        """ gets the least loaded healthy master key from the guild pool
+            the pool is loaded from the server admins on first use and reloaded on !sync
+            return 0, id, Key: All good
+            return -1, None, None: no key given
         """
-        import random
         c = self.configurations.get(guild.id)
         if c is None:
             return -1, None, None
 
-        torn_ids = [v["torn_id"] for k, v in c.get("admin", {}).get("server_admins", {}).items()]
-        if len(torn_ids):
-            user = await get_yata_user(random.choice(torn_ids), type="T")
-            if not len(user):
-                return -1, None, None
-            else:
-                user = tuple(user[0])
-                return 0, user[0], user[2]
-        else:
+        if not self.master_keys.loaded(guild.id):
+            torn_ids = [v["torn_id"] for k, v in c.get("admin", {}).get("server_admins", {}).items()]
+            await self.master_keys.load(guild.id, torn_ids)
+
+        tornId, key = self.master_keys.pick(guild.id)
+        if key is None:
             return -1, None, None
+        else:
+            return 0, tornId, key
+
+    def invalidate_identity(self, discord_id):
+        """ forgets the cached identity of a discord user (re-registered, verified, key changed)
+        """
+        if self.identities.pop(int(discord_id)) is not None:
+            logging.debug(f"[invalidate_identity] discord id {discord_id}")
+
+    async def send_user_key_error(self, ctx, message, delError=False):
+        if ctx:
+            m = await ctx.send(f'```md\n# Get torn ID\n< error > {message}```')
+            if delError:
+                await asyncio.sleep(5)
+                await m.delete()
 
     async def get_user_key(self, ctx, member, needPerm=True, returnMaster=False, delError=False, guild=False):
         """ gets a key from discord member
@@ -102,27 +201,49 @@ class YataBot(Bot):
 
             if returnMaster: return master key if key not available
             else return None
+
+            identities (positive and negative) are cached in memory
+            (invalidated on a revoked key, on verification and when the notifier sees a new key)
         """
         guild = ctx.guild if not guild and ctx else guild
 
+        # cached identity
+        identity = self.identities.get(member.id)
+        if identity is not None and identity[0] == 0:
+            # drop identities with an invalid key
+            errors = self.torn_api.key_errors(identity[3])
+            if not self.torn_api.key_healthy(identity[3]) and len(errors) and errors[-1][1] == 2:
+                self.invalidate_identity(member.id)
+            else:
+                return identity
+
+        elif identity is not None:
+            status, tornId = identity
+            master_status, master_id, master_key = await self.get_master_key(guild)
+            if master_status == -1:
+                await self.send_user_key_error(ctx, 'no master key given', delError=delError)
+                return -1, None, None, None
+            if status == -3:
+                await self.send_user_key_error(ctx, f'{member} are not not officially verified by Torn', delError=delError)
+            else:
+                await self.send_user_key_error(ctx, f'{member} is not in the YATA database. They have to log there so that I can use their key: https://yata.alwaysdata.net', delError=delError)
+            return status, master_id if status == -3 else tornId, None, master_key if returnMaster else None
+
         # skip all if user in yata with discord id
         user = await get_yata_user(member.id, type="D")
         if len(user):
             user = tuple(user[0])
             logging.debug(f"[get_user_key] got user from discord id: {user[1]} {user[0]}")
+            self.identities.set(member.id, (0, user[0], user[1], user[2]))
             return 0, user[0], user[1], user[2]
 
         # get master key to check identity
 
         # logging.info(f"[GET USER KEY] <{ctx.guild}> get master key")
-        master_status, master_id, master_key = await self.get_master_key(ctx.guild)
+        master_status, master_id, master_key = await self.get_master_key(guild)
         if master_status == -1:
             # logging.info(f"[GET USER KEY] <{ctx.guild}> no master key given")
-            if ctx:
-                m = await ctx.send(f'```md\n# Get torn ID\n< error > no master key given```')
-                if delError:
-                    await asyncio.sleep(5)
-                    await m.delete()
+            await self.send_user_key_error(ctx, 'no master key given', delError=delError)
             return -1, None, None, None
         # logging.info(f"[GET USER KEY] <{ctx.guild}> master key id {master_id}")
 
@@ -135,19 +256,12 @@ class YataBot(Bot):
 
         if tornId == -1:
             # logging.info(f'[GET MEMBER KEY] status -1: master key error {msg["error"]}')
-            if ctx:
-                m = await ctx.send(f'```md\n# Get torn ID\n< error > Torn API error with master key id {master_id}: {msg["error"]}```')
-                if delError:
-                    await asyncio.sleep(5)
-                    await m.delete()
+            await self.send_user_key_error(ctx, f'Torn API error with master key id {master_id}: {msg["error"]}', delError=delError)
             return -2, None, None, None
         elif tornId == -2:
             # logging.info(f'[GET MEMBER KEY] status -2: user not verified')
-            if ctx:
-                m = await ctx.send(f'```md\n# Get torn ID\n< error > {member} are not not officially verified by Torn```')
-                if delError:
-                    await asyncio.sleep(5)
-                    await m.delete()
+            self.identities.set(member.id, (-3, None), ttl=self.identity_ttl[1])
+            await self.send_user_key_error(ctx, f'{member} are not not officially verified by Torn', delError=delError)
             return -3, master_id, None, master_key if returnMaster else None
 
         # get YATA user
@@ -157,16 +271,14 @@ class YataBot(Bot):
         # handle user not on YATA
         if not len(user):
             # logging.info(f"[GET MEMBER KEY] torn id {tornId} not in YATA")
-            if ctx:
-                m = await ctx.send(f'```md\n# Get torn ID\n< error > {member} is not in the YATA database. They have to log there so that I can use their key: https://yata.alwaysdata.net```')
-                if delError:
-                    await asyncio.sleep(5)
-                    await m.delete()
+            self.identities.set(member.id, (-4, tornId), ttl=self.identity_ttl[1])
+            await self.send_user_key_error(ctx, f'{member} is not in the YATA database. They have to log there so that I can use their key: https://yata.alwaysdata.net', delError=delError)
             return -4, tornId, None, master_key if returnMaster else None
 
         # Return user if perm given
 
         user = tuple(user[0])
+        self.identities.set(member.id, (0, user[0], user[1], user[2]))
         return 0, user[0], user[1], user[2]
 
     async def on_ready(self):
@@ -174,11 +286,19 @@ class YataBot(Bot):
         # activity = discord.Activity(name="TORN", type=discord.ActivityType.playing)
         # await self.change_presence(activity=activity)
 
-        logging.info("[SETUP] Ready...")
+        logging.info(f'[SETUP] {"Notifier worker" if self.notify_worker else "Bot"} ready...')
+
+        # startup timing breakdown (only on the first connection)
+        if self.startup is not None:
+            started, phases = self.startup
+            total = time.monotonic() - started
+            phases.append(("discord", total - sum([p[1] for p in phases])))
+            logging.info(f'[SETUP] ready in {total:.2f}s: {", ".join([f"{k} {v:.2f}s" for k, v in phases])}')
+            self.startup = None
 
     def get_guilds_by_module(self, module):
-        guilds = [g for g in self.guilds if self.configurations.get(g.id, {}).get(module, False)]
-        return guilds
+        guilds = [self.get_guild(id) for id in self.configurations.guilds(module)]
+        return [g for g in guilds if g is not None]
 
     def get_guild_configuration_by_module(self, guild, module, check_key=False):
         c = self.configurations.get(guild.id, {}).get(module, False)
@@ -188,17 +308,54 @@ class YataBot(Bot):
             return c
 
     def get_guild_admin_channel(self, guild):
-        admin_id = [k for k in self.configurations.get(guild.id, {}).get("admin", {}).get("channels_admin", {})]
-        if len(admin_id) and str(admin_id[0]).isdigit():
-            return get(guild.channels, id=int(admin_id[0]))
+        admin_id = self.configurations.get_ids(guild.id, "admin", "channels_admin")
+        if len(admin_id):
+            return guild.get_channel(admin_id[0])
         else:
             return None
 
+    def get_guild_module_role(self, guild, module, key, all=False):
+        """ gets the role of a module from the configuration index:
+            - module: name of the module (ex: verify)
+            - key: key of the module configuration (ex: roles_verified)
+            - all: return all roles if true, only the first one if False
+
+            return: role, list of roles or None (if didn't find anything)
+        """
+        roles = [guild.get_role(id) for id in self.configurations.get_ids(guild.id, module, key)]
+        if all:
+            return roles if len(roles) else [None]
+        else:
+            return roles[0] if len(roles) else None
+
+    def get_guild_module_channel(self, guild, module, key, all=False):
+        """ gets the channel of a module from the configuration index:
+            - module: name of the module (ex: loot)
+            - key: key of the module configuration (ex: channels_alerts)
+            - all: return all channels if true, only the first one if False
+
+            return: channel, list of channels or None (if didn't find anything)
+        """
+        channels = [guild.get_channel(id) for id in self.configurations.get_ids(guild.id, module, key)]
+        if all:
+            return channels if len(channels) else [None]
+        else:
+            return channels[0] if len(channels) else None
+
     async def check_channel_allowed(self, ctx, config, channel_key=None):
         channel_key = "channels_allowed" if channel_key is None else channel_key
 
-        if str(ctx.channel.id) not in config.get(channel_key, []):
-            channels = [get(ctx.guild.channels, id=int(k)) for k in config.get(channel_key, {}) if str(k).isdigit()]
+        # use the configuration index if the configuration is a module of the guild
+        module = self.configurations.find_module(ctx.guild.id, config)
+        if module is None:
+            allowed = str(ctx.channel.id) in config.get(channel_key, [])
+            channel_ids = [int(k) for k in config.get(channel_key, {}) if str(k).isdigit()]
+        else:
+            allowed = self.configurations.has_id(ctx.guild.id, module, channel_key, ctx.channel.id)
+            channel_ids = self.configurations.get_ids(ctx.guild.id, module, channel_key)
+
+        if not allowed:
+            channels = [ctx.guild.get_channel(id) for id in channel_ids]
             allowed_channels = [c.mention for c in channels if c is not None]
             if len(allowed_channels):
                 msg = await ctx.send(f':no_entry: Command not allowed in this channel. Try {", ".join(allowed_channels)}.')
@@ -224,7 +381,7 @@ class YataBot(Bot):
             return True
 
     async def send_log_main(self, log, headers=dict({}), full=False):
-        guild = get(self.guilds, id=self.main_server_id)
+        guild = self.get_guild(self.main_server_id)
         logging.debug(f'[send_log_main] Guild: {guild}')
         channel = self.get_guild_admin_channel(guild)
         logging.debug(f'[send_log_main] channel: {channel}')
@@ -257,7 +414,7 @@ class YataBot(Bot):
             return
 
         logging.debug(f'[send_log] guild_id: {guild_id} channel_id: {channel_id}')
-        guild = get(self.guilds, id=guild_id)
+        guild = self.get_guild(guild_id)
         headers["guild"] = guild
 
         # fallback is guild not found
@@ -266,7 +423,7 @@ class YataBot(Bot):
             await self.send_log_main(log, headers=headers)
             return
 
-        channel = get(guild.channels, id=channel_id)
+        channel = guild.get_channel(channel_id)
         if channel is None:
             headers["note"].append("channel id not provided")
             channel = self.get_guild_admin_channel(guild)
@@ -347,6 +504,8 @@ class YataBot(Bot):
                 return None
 
     async def on_guild_join(self, guild):
+        if self.notify_worker:
+            return
 
         await self.send_log_main(f'I **joined** server {guild} [`{guild.id}`] owned by {guild.owner} ')
 
@@ -354,6 +513,8 @@ class YataBot(Bot):
         await set_configuration(self.bot_id, guild.id, guild.name, self.configurations[guild.id])
 
     async def on_guild_remove(self, guild):
+        if self.notify_worker:
+            return
 
         await self.send_log_main(f'I **left** server {guild} [`{guild.id}`] owned by {guild.owner}')
 
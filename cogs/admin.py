@@ -42,6 +42,7 @@ from inc.yata_db import set_configuration
 from inc.yata_db import get_configuration
 from inc.yata_db import set_n_servers
 from inc.yata_db import get_yata_user
+from inc.metrics import registry as task_metrics
 
 from inc.handy import *
 
@@ -168,6 +169,9 @@ class Admin(commands.Cog):
 
         self.bot.configurations[ctx.guild.id] = configuration
 
+        # reload master keys from the new server admins
+        await self.bot.master_keys.load(ctx.guild.id, [v["torn_id"] for v in server_admins.values()])
+
         if len(updates) < 3:
             updates.append("< none >")
         updates.append("```Check out your dashboard: https://yata.alwaysdata.net/bot/dashboard/")
@@ -199,6 +203,52 @@ class Admin(commands.Cog):
         for server_id in [s for s in self.bot.configurations if s not in [g.id for g in self.bot.guilds]]:
             await ctx.send(f'```No bot in configuration id {server_id}```')
 
+    @commands.command()
+    async def apistats(self, ctx, *args):
+        """Admin tool for the bot owner"""
+        logging.info(f'[admin/apistats] {ctx.guild}: {ctx.author.nick} / {ctx.author}')
+
+        if ctx.author.id != 227470975317311488:
+            logging.info(f'[admin/apistats] not authorized')
+            return
+
+        lst = ["```md", "# Torn API client"]
+        for k, v in self.bot.torn_api.metrics().items():
+            lst.append(f'< {k} > {v:.2f}' if isinstance(v, float) else f'< {k} > {v}')
+        lst.append("# Identity cache")
+        lst.append(f'< size > {len(self.bot.identities)}')
+        for k, v in self.bot.identities.stats.items():
+            lst.append(f'< {k} > {v}')
+        lst.append("# Live messages")
+        lst.append(f'< tracked > {len(self.bot.live.messages)}')
+        for k, v in self.bot.live.stats.items():
+            lst.append(f'< {k} > {v}')
+        lst.append("# Direct messages")
+        lst.append(f'< blocked users > {len(self.bot.dms.blocked)}')
+        for k, v in self.bot.dms.stats.items():
+            lst.append(f'< {k} > {v}')
+        lst.append("```")
+        await ctx.send("\n".join(lst))
+
+    @commands.command()
+    async def taskstats(self, ctx, *args):
+        """Admin tool for the bot owner"""
+        logging.info(f'[admin/taskstats] {ctx.guild}: {ctx.author.nick} / {ctx.author}')
+
+        if ctx.author.id != 227470975317311488:
+            logging.info(f'[admin/taskstats] not authorized')
+            return
+
+        lst = ["```md"]
+        for name, metrics in task_metrics.items():
+            lst.append(f"# {name}")
+            for k, v in metrics.as_dict().items():
+                lst.append(f'< {k} > {v:.2f}' if isinstance(v, float) else f'< {k} > {v}')
+        if len(lst) == 1:
+            lst.append("< none > no task metrics")
+        lst.append("```")
+        await ctx.send("\n".join(lst))
+
     @commands.command()
     @commands.has_any_role(679669933680230430, 669682126203125760)
     async def info(self, ctx, *args):
@@ -487,7 +537,7 @@ class Admin(commands.Cog):
             return
 
         # get role
-        role = self.bot.get_module_role(ctx.guild.roles, config.get("roles_alerts", {}))
+        role = self.bot.get_guild_module_role(ctx.guild, module, "roles_alerts")
 
         if role is None:
             # not role
@@ -525,7 +575,7 @@ class Admin(commands.Cog):
             return
 
         # get welcome channel
-        welcome_channel = self.bot.get_module_channel(member.guild.channels, config.get("channels_welcome", {}))
+        welcome_channel = self.bot.get_guild_module_channel(member.guild, "admin", "channels_welcome")
 
         # fall back to system channel
         if welcome_channel is None:
@@ -18,12 +18,12 @@ This file is part of yata-bot.
 """
 
 # import standard modules
-import aiohttp
 import asyncio
-import asyncpg
+import os
+import heapq
+import socket
 import json
 import re
-import os
 import html
 import logging
 
@@ -35,17 +35,59 @@ from discord.utils import get
 
 # import bot functions and classes
 from inc.yata_db import reset_notifications
+from inc.yata_db import get_pool
+from inc.yata_db import update_notifications
+from inc.yata_db import init_notifier_leases
+from inc.yata_db import lease_notifier_partitions
+from inc.yata_db import release_notifier_partitions
+from inc.metrics import get_task_metrics
 from inc.handy import *
 
+# personal notifications: number of notifiers processed at the same time and maximum time of a notifier in seconds
+NOTIFY_CONCURRENCY = int(os.environ.get("NOTIFY_CONCURRENCY", 20))
+NOTIFY_TIMEOUT = int(os.environ.get("NOTIFY_TIMEOUT", 45))
+
+# personal notifications scheduling in seconds
+# each notifier is fetched shortly before its earliest timer reaches the NOTIFY_THRESHOLD,
+# every NOTIFY_BASELINE for the events, messages and awards and at least every NOTIFY_MAX_DELAY
+NOTIFY_TICK = 15
+NOTIFY_THRESHOLD = 90
+NOTIFY_BASELINE = int(os.environ.get("NOTIFY_BASELINE", 180))
+NOTIFY_MAX_DELAY = int(os.environ.get("NOTIFY_MAX_DELAY", 900))
+NOTIFY_REFRESH = 60  # reload of the notifiers from the database
+NOTIFY_SEEN = 200  # events and messages notified remembered per notifier
+
+# personal notifications partitions (torn id % NOTIFY_PARTITIONS) shared by the notifier processes
+# each process renews the leases of the partitions it serves every NOTIFY_HEARTBEAT, apart from the ticks
+# leases not renewed within NOTIFY_LEASE_TTL (process crashed or hung) are claimed by the other processes
+# the lease tables are in sql/notifier_leases.sql
+NOTIFY_PARTITIONS = int(os.environ.get("NOTIFY_PARTITIONS", 16))
+NOTIFY_LEASE_TTL = int(os.environ.get("NOTIFY_LEASE_TTL", 3 * NOTIFY_REFRESH))
+NOTIFY_HEARTBEAT = max(NOTIFY_TICK, NOTIFY_LEASE_TTL // 3)
+
 
 class API(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.notify_semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self.notify_metrics = get_task_metrics("notify", interval=NOTIFY_TICK)
+        self.notifiers = dict({})  # torn id -> {"dId", "key", "notifications"}
+        self.notify_heap = []  # (due, torn id) priority queue of the next fetches
+        self.notify_due = dict({})  # torn id -> due (entries of the heap with another due are stale)
+        self.notify_refreshed = 0
+        self.notify_writes = dict({})  # torn id -> notifications state changed since the last write
+        self.notify_owner = f'{socket.gethostname()}-{os.getpid()}'  # owner of the leases
+        self.notify_partitions = set()  # partitions leased by this process
+        self.notify_leased = 0  # last renewal of the leases
         if self.bot.bot_id == 3:
+            self.notify_heartbeat.start()
             self.notify.start()
 
     def cog_unload(self):
         self.notify.cancel()
+        self.notify_heartbeat.cancel()
+        if len(self.notify_partitions):
+            asyncio.get_event_loop().create_task(self._notify_unlease())
 
     @commands.command(aliases=['we'])
     @commands.guild_only()
@@ -61,10 +103,7 @@ class API(commands.Cog):
             return
 
         # make api call
-        url = f"https://api.torn.com/user/?selections=discord,weaponexp&key={key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                req = await r.json()
+        req = await self.bot.torn_api.get("user", "", "discord,weaponexp", key)
 
         # handle API error
         if "error" in req:
@@ -130,10 +169,7 @@ class API(commands.Cog):
             return
 
         # make api call
-        url = f"https://api.torn.com/user/?selections=discord,personalstats&key={key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                req = await r.json()
+        req = await self.bot.torn_api.get("user", "", "discord,personalstats", key)
 
         # handle API error
         if "error" in req:
@@ -179,10 +215,7 @@ class API(commands.Cog):
             return
 
         # make api call
-        url = f"https://api.torn.com/user/?selections=discord,networth&key={key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                req = await r.json()
+        req = await self.bot.torn_api.get("user", "", "discord,networth", key)
 
         # handle API error
         if "error" in req:
@@ -266,10 +299,7 @@ class API(commands.Cog):
             return
 
         # Torn API call
-        url = f'https://api.torn.com/user/{tornId}?selections=profile,personalstats&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                r = await r.json()
+        r = await self.bot.torn_api.get("user", tornId, "profile,personalstats", key)
 
         if 'error' in r:
             await ctx.send(f'Error code {r["error"]["code"]}: {r["error"]["error"]}')
@@ -339,220 +369,441 @@ class API(commands.Cog):
         for k, v in links.items():
             await ctx.send(f'<{k}> {v}')
 
-    @tasks.loop(minutes=1)
+    def _notify_schedule(self, tId, delay):
+        due = ts_now() + int(delay)
+        self.notify_due[tId] = due
+        heapq.heappush(self.notify_heap, (due, tId))
+
+    async def _notify_lease(self):
+        """ heartbeat of the leases of the partitions (fair share of ceil(partitions / processes))
+            the partitions over the share are released (a process joined) and free or expired ones are claimed (a process left, died or hung)
+        """
+        try:
+            if not self.notify_leased:
+                await init_notifier_leases(NOTIFY_PARTITIONS)
+            partitions = self.notify_partitions
+            workers, self.notify_partitions = await lease_notifier_partitions(self.notify_owner, NOTIFY_PARTITIONS, NOTIFY_LEASE_TTL)
+            self.notify_leased = ts_now()
+
+            if partitions != self.notify_partitions:
+                logging.info(f'[api/notifications] {workers} notifier processes: serving {len(self.notify_partitions)} / {NOTIFY_PARTITIONS} partitions {sorted(self.notify_partitions)}')
+                # reload the notifiers on the next tick
+                self.notify_refreshed = 0
+
+        except asyncio.CancelledError:
+            raise
+
+        except BaseException as e:
+            logging.error(f'[api/notifications] partitions lease (tables of sql/notifier_leases.sql): {hide_key(e)}')
+
+        self._notify_lease_check()
+
+    def _notify_lease_check(self):
+        """ stops serving the partitions if the leases have not been renewed in time (they may have been claimed by another process)
+        """
+        if len(self.notify_partitions) and ts_now() - self.notify_leased > NOTIFY_LEASE_TTL:
+            logging.warning(f'[api/notifications] partitions lease expired: stop serving {sorted(self.notify_partitions)}')
+            self.notify_partitions = set()
+            self.notify_refreshed = 0
+
+    def _notify_served(self, tId):
+        return tId % NOTIFY_PARTITIONS in self.notify_partitions
+
+    @tasks.loop(seconds=NOTIFY_HEARTBEAT)
+    async def notify_heartbeat(self):
+        """ renews the leases apart from the ticks (a long tick does not let them expire)
+        """
+        await self._notify_lease()
+
+    @notify_heartbeat.before_loop
+    async def before_notify_heartbeat(self):
+        await self.bot.wait_until_ready()
+
+    async def _notify_unlease(self):
+        """ releases the partitions (they would be claimed by the other processes when the leases expire anyway)
+        """
+        self.notify_partitions = set()
+        try:
+            await release_notifier_partitions(self.notify_owner)
+        except BaseException as e:
+            logging.warning(f'[api/notifications] partitions release: {hide_key(e)}')
+
+    async def _notify_refresh(self):
+        """ reloads the notifiers of the partitions served from the YATA database
+            new notifiers and notifiers with new preferences or a new key are due at once
+        """
+        if len(self.notify_partitions):
+            sql = 'SELECT "tId", "dId", "notifications", "value" FROM player_view_player_key WHERE "activateNotifications" = True AND "tId" % $1 = ANY($2::int[]);'
+            records = await get_pool().fetch(sql, NOTIFY_PARTITIONS, sorted(self.notify_partitions), timeout=10)
+        else:
+            records = []
+        self.notify_refreshed = ts_now()
+
+        active = set()
+        for record in records:
+            tId = record["tId"]
+            active.add(tId)
+            notifications = json.loads(record["notifications"])
+
+            # clean the states written under the wrong key
+            if "messages" in notifications:
+                del notifications["messages"]
+                self.notify_writes[tId] = json.dumps(notifications)
+
+            notifier = self.notifiers.get(tId)
+            # a new key or a new discord account on YATA: forget the cached identities
+            if notifier is not None and (notifier["key"] != record["value"] or notifier["dId"] != record["dId"]):
+                self.bot.invalidate_identity(notifier["dId"])
+                self.bot.invalidate_identity(record["dId"])
+
+            if notifier is None or notifier["key"] != record["value"] or notifier["dId"] != record["dId"] or set(notifier["notifications"]) != set(notifications):
+                self.notifiers[tId] = {"dId": record["dId"], "key": record["value"], "notifications": notifications}
+                self._notify_schedule(tId, 0)
+
+        # forget the notifiers who turned the notifications off (or in a partition served by another process)
+        for tId in [tId for tId in self.notifiers if tId not in active]:
+            del self.notifiers[tId]
+            self.notify_due.pop(tId, None)
+
+        # drop the stale entries of the queue
+        if len(self.notify_heap) > 2 * len(self.notify_due) + 100:
+            self.notify_heap = [(due, tId) for due, tId in self.notify_heap if self.notify_due.get(tId) == due]
+            heapq.heapify(self.notify_heap)
+
+    def _notify_delay(self, notifications, req):
+        """ seconds before the next fetch of a notifier
+            shortly before the earliest timer reaches the threshold, NOTIFY_BASELINE for events, messages and awards
+            the timers already notified or not running can start any time: NOTIFY_MAX_DELAY
+        """
+        timers = []
+        if "energy" in notifications:
+            timers.append(req["energy"]["fulltime"])
+        if "nerve" in notifications:
+            timers.append(req["nerve"]["fulltime"])
+        if "chain" in notifications and req["chain"]["current"] > 10:
+            # the timeout resets on every hit
+            timers.append(min(req["chain"]["timeout"], NOTIFY_BASELINE + NOTIFY_THRESHOLD))
+        if "education" in notifications:
+            timers.append(req["education_timeleft"])
+        if "bank" in notifications:
+            timers.append(req["city_bank"]["time_left"])
+        for cooldown in ["drug", "medical", "booster"]:
+            if cooldown in notifications:
+                timers.append(req["cooldowns"][cooldown])
+        if "travel" in notifications:
+            timers.append(req["travel"]["time_left"])
+
+        delays = [NOTIFY_MAX_DELAY]
+        if "event" in notifications or "message" in notifications or "award" in notifications:
+            delays.append(NOTIFY_BASELINE)
+        for timer in timers:
+            # when fetched the timer is a tick under the threshold
+            if timer >= NOTIFY_THRESHOLD:
+                delays.append(timer - NOTIFY_THRESHOLD + NOTIFY_TICK)
+
+        return max(NOTIFY_TICK, min(delays))
+
+    @tasks.loop(seconds=NOTIFY_TICK)
     async def notify(self):
         logging.debug("[api/notifications] start task")
+        self.notify_metrics.start()
 
         # main guild
         guild = get(self.bot.guilds, id=self.bot.main_server_id)
 
-        # connect to YATA database of notifiers
-        db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-        dbname = db_cred["dbname"]
-        del db_cred["dbname"]
-        sql = 'SELECT "tId", "dId", "notifications", "value" FROM player_view_player_key WHERE "activateNotifications" = True;'
-        con = await asyncpg.connect(database=dbname, **db_cred)
-
-        # async loop over notifiers
-        async with con.transaction():
-            async for record in con.cursor(sql, prefetch=100, timeout=2):
-                # get corresponding discord member
-                member = get(guild.members, id=record["dId"])
-                if member is None:
-                    logging.warning(f'[api/notifications] reset notifications for discord [{record["dId"]}] torn [{record["tId"]}]')
-                    # headers = {"error": "notifications", "discord": record["dId"], "torn": record["tId"]}
-                    # await self.bot.send_log_main("member not found", headers=headers)
-                    await reset_notifications(record["tId"])
-                    continue
-
-                try:
-
-                    # get notifications preferences
-                    logging.debug(f'[api/notifications] {member.nick} / {member}')
-                    notifications = json.loads(record["notifications"])
-
-                    # get selections for Torn API call
-                    keys = []
-                    if "event" in notifications:
-                        keys.append("events")
-                        keys.append("notifications")
-                    if "message" in notifications:
-                        keys.append("messages")
-                        keys.append("notifications")
-                    if "award" in notifications:
-                        keys.append("notifications")
-                    if "energy" in notifications:
-                        keys.append("bars")
-                    if "nerve" in notifications:
-                        keys.append("bars")
-                    if "chain" in notifications:
-                        keys.append("bars")
-                    if "education" in notifications:
-                        keys.append("education")
-                    if "bank" in notifications:
-                        keys.append("money")
-                    if "drug" in notifications:
-                        keys.append("cooldowns")
-                    if "medical" in notifications:
-                        keys.append("cooldowns")
-                    if "booster" in notifications:
-                        keys.append("cooldowns")
-                    if "travel" in notifications:
-                        keys.append("travel")
-
-                    # make Torn API call
-                    url = f'https://api.torn.com/user/?selections={",".join(list(set(keys)))}&key={record["value"]}'
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url) as r:
-                            req = await r.json()
-
-                    if 'error' in req:
-                        logging.warning(f'[api/notifications] {member.nick} / {member} error in api payload: {req["error"]["code"]}: {req["error"]["error"]}')
-                        continue
-
-                    # notify event
-                    if "event" in notifications:
-                        if not req["notifications"]["events"]:
-                            notifications["event"] = dict({})
-                        else:
-                            # loop over events
-                            for k, v in req["events"].items():
-                                # if new event not notified -> notify
-                                if not v["seen"] and k not in notifications["event"]:
-                                    await member.send(cleanhtml(v["event"]).replace(" [View]", ""))
-                                    notifications["event"][k] = True
-
-                                # if seen even already notified -> clean table
-                                elif v["seen"] and k in notifications["event"]:
-                                    del notifications["event"][k]
-
-                    # notify message
-                    if "message" in notifications:
-                        if not req["notifications"]["messages"]:
-                            notifications["messages"] = dict({})
-                        else:
-                            # loop over messages
-                            for k, v in req["messages"].items():
-                                # if new event not notified -> notify
-                                if not v["seen"] and k not in notifications["message"]:
-                                    await member.send(f'New message from {v["name"]}: {v["title"]}')
-                                    notifications["message"][k] = True
-
-                                # if seen even already notified -> clean table
-                                elif v["seen"] and k in notifications["message"]:
-                                    del notifications["message"][k]
-
-                    # notify awards
-                    if "award" in notifications:
-                        if req["notifications"]["awards"]:
-                            # if new award or different number of awards
-                            if not notifications["award"].get("notified", False) or notifications["award"].get("notified") != req["notifications"]["awards"]:
-                                s = "s" if req["notifications"]["awards"] > 1 else ""
-                                await member.send(f'You have {req["notifications"]["awards"]} new award{s}')
-                                notifications["award"]["notified"] = req["notifications"]["awards"]
-
-                        else:
-                            notifications["award"] = dict({})
-
-                    # notify energy
-                    if "energy" in notifications:
-                        if req["energy"]["fulltime"] < 90:
-                            if not notifications["energy"].get("notified", False):
-                                await member.send(f'Energy at {req["energy"]["current"]} / {req["energy"]["maximum"]}')
-                            notifications["energy"]["notified"] = True
-
-                        else:
-                            notifications["energy"] = dict({})
-
-                    # notify nerve
-                    if "nerve" in notifications:
-                        if req["nerve"]["fulltime"] < 90:
-                            if not notifications["nerve"].get("notified", False):
-                                await member.send(f'Nerve at {req["nerve"]["current"]} / {req["nerve"]["maximum"]}')
-                            notifications["nerve"]["notified"] = True
-
-                        else:
-                            notifications["nerve"] = dict({})
-
-                    # notify chain
-                    if "chain" in notifications:
-                        if req["chain"]["timeout"] < 90 and req["chain"]["current"] > 10:
-                            if not notifications["chain"].get("notified", False):
-                                await member.send(f'Chain timeout in {req["chain"]["timeout"]} seconds')
-                            notifications["chain"]["notified"] = True
-
-                        else:
-                            notifications["chain"] = dict({})
-
-                    # notify education
-                    if "education" in notifications:
-                        if req["education_timeleft"] < 90:
-                            if not notifications["education"].get("notified", False):
-                                await member.send(f'Education ends in {req["education_timeleft"]} seconds')
-                            notifications["education"]["notified"] = True
-
-                        else:
-                            notifications["education"] = dict({})
-
-                    # notify bank
-                    if "bank" in notifications:
-                        if req["city_bank"]["time_left"] < 90:
-                            if not notifications["bank"].get("notified", False):
-                                await member.send(f'Bank investment ends in {req["city_bank"]["time_left"]} seconds (${req["city_bank"]["amount"]:,.0f})')
-                            notifications["bank"]["notified"] = True
-
-                        else:
-                            notifications["bank"] = dict({})
-
-                    # notify drug
-                    if "drug" in notifications:
-                        if req["cooldowns"]["drug"] < 90:
-                            if not notifications["drug"].get("notified", False):
-                                await member.send(f'Drug cooldown ends in {req["cooldowns"]["drug"]} seconds')
-                            notifications["drug"]["notified"] = True
-
-                        else:
-                            notifications["drug"] = dict({})
-
-                    # notify medical
-                    if "medical" in notifications:
-                        if req["cooldowns"]["medical"] < 90:
-                            if not notifications["medical"].get("notified", False):
-                                await member.send(f'Medical cooldown ends in {req["cooldowns"]["medical"]} seconds')
-                            notifications["medical"]["notified"] = True
-
-                        else:
-                            notifications["medical"] = dict({})
-
-                    # notify booster
-                    if "booster" in notifications:
-                        if req["cooldowns"]["booster"] < 90:
-                            if not notifications["booster"].get("notified", False):
-                                await member.send(f'Booster cooldown ends in {req["cooldowns"]["booster"]} seconds')
-                            notifications["booster"]["notified"] = True
-
-                        else:
-                            notifications["booster"] = dict({})
-
-                    # notify travel
-                    if "travel" in notifications:
-                        if req["travel"]["time_left"] < 90:
-                            if not notifications["travel"].get("destination", False):
-                                await member.send(f'Landing in {req["travel"]["destination"]} in {req["travel"]["time_left"]} seconds')
-                            notifications["travel"] = req["travel"]
-
-                        else:
-                            notifications["travel"] = dict({})
-
-                    # update notifications in YATA's database
-                    await con.execute('UPDATE player_player SET "notifications"=$1 WHERE "dId"=$2', json.dumps(notifications), member.id)
-
-                except BaseException as e:
-                    logging.error(f'[api/notifications] {member.nick} / {member}: {hide_key(e)}')
-                    # headers = {"guild": guild, "guild_id": guild.id, "member": f'{member.nick} / {member}', "error": "personal notification error"}
-                    # await self.bot.send_log_main(e, headers=headers, full=True)
-
-        await con.close()
+        # notifiers of the YATA database (no transaction held during the API calls and the DMs)
+        self._notify_lease_check()
+        if ts_now() - self.notify_refreshed >= NOTIFY_REFRESH:
+            await self._notify_refresh()
+
+        # notifiers due
+        now = ts_now()
+        due = []
+        while len(self.notify_heap) and self.notify_heap[0][0] <= now:
+            t, tId = heapq.heappop(self.notify_heap)
+            if self.notify_due.get(tId) == t:
+                del self.notify_due[tId]
+                if self._notify_served(tId):
+                    due.append(tId)
+
+        jobs = []
+        for tId in due:
+            notifier = self.notifiers[tId]
+
+            # get corresponding discord member
+            member = guild.get_member(notifier["dId"])
+            if member is None:
+                logging.warning(f'[api/notifications] reset notifications for discord [{notifier["dId"]}] torn [{tId}]')
+                # headers = {"error": "notifications", "discord": notifier["dId"], "torn": tId}
+                # await self.bot.send_log_main("member not found", headers=headers)
+                await reset_notifications(tId)
+                del self.notifiers[tId]
+                continue
+
+            # do not fetch the members who do not accept direct messages
+            if self.bot.dms.is_blocked(member.id):
+                self._notify_schedule(tId, NOTIFY_MAX_DELAY)
+                continue
+
+            jobs.append(self._notify_job(member, tId, notifier))
+
+        # notifiers run concurrently (bounded by the semaphore and by the rate limit of each key)
+        await asyncio.gather(*jobs)
+
+        # one direct message per member and one write for all the notifications states that changed
+        await self.bot.dms.flush()
+        await self._notify_flush()
+
+        duration = self.notify_metrics.stop(jobs=len(jobs))
+        if duration > self.notify_metrics.interval:
+            logging.warning(f'[api/notifications] tick overrun: {len(jobs)} notifiers in {duration:.1f}s')
+        else:
+            logging.debug(f'[api/notifications] {len(jobs)} notifiers in {duration:.1f}s')
+
+    async def _notify_job(self, member, tId, notifier):
+        """ runs the notifications of a member (bounded concurrency and time)
+            and schedules its next run
+        """
+        delay = NOTIFY_BASELINE
+        async with self.notify_semaphore:
+            try:
+                delay = await asyncio.wait_for(self._notify_member(member, tId, notifier), NOTIFY_TIMEOUT)
+
+            except asyncio.TimeoutError:
+                self.notify_metrics.timeouts += 1
+                logging.warning(f'[api/notifications] {member.nick} / {member}: timed out after {NOTIFY_TIMEOUT}s')
+
+            except BaseException as e:
+                self.notify_metrics.errors += 1
+                logging.error(f'[api/notifications] {member.nick} / {member}: {hide_key(e)}')
+                # headers = {"guild": guild, "guild_id": guild.id, "member": f'{member.nick} / {member}', "error": "personal notification error"}
+                # await self.bot.send_log_main(e, headers=headers, full=True)
+
+        if self.notifiers.get(tId) is notifier:
+            self._notify_schedule(tId, delay)
+
+    async def _notify_flush(self):
+        """ writes the notifications states that changed in one batch (merged with jsonb ||)
+            the states are kept for the next tick if the write fails
+        """
+        if not len(self.notify_writes):
+            return
+
+        writes = self.notify_writes
+        self.notify_writes = dict({})
+        try:
+            # merged into the notifications of the database (preferences may have changed on YATA since the refresh)
+            await update_notifications(list(writes.items()), deleted=["messages"])
+            logging.debug(f'[api/notifications] {len(writes)} notifications states written')
+        except BaseException as e:
+            logging.error(f'[api/notifications] write of {len(writes)} notifications states: {hide_key(e)}')
+            for tId, state in writes.items():
+                self.notify_writes.setdefault(tId, state)
+
+    def _notify_push(self, member, tId, line, name, key, value):
+        """ queues a DM and sets notifications[name][key] (or notifications[name] if key is None) to value once delivered
+            a DM that fails is not marked as notified (sent again on the next fetch)
+        """
+        def delivered():
+            notifier = self.notifiers.get(tId)
+            if notifier is None or name not in notifier["notifications"]:
+                return
+            if key is None:
+                notifier["notifications"][name] = value
+            else:
+                notifier["notifications"][name][key] = value
+            self.notify_writes[tId] = json.dumps(notifier["notifications"])
+
+        self.bot.dms.push(member, line, callback=delivered)
+
+    def _notify_prune(self, notified, payload):
+        """ forgets the ids notified that are not in the payload anymore and keeps the NOTIFY_SEEN most recent
+        """
+        ids = sorted([k for k in notified if k in payload], key=lambda k: -int(k) if k.isdigit() else 0)
+        return {k: notified[k] for k in ids[:NOTIFY_SEEN]}
+
+    async def _notify_member(self, member, tId, notifier):
+        """ fetches the notifier payload, queues the DMs and updates the notifications state
+            works on a copy of the state: nothing changes if the notifier times out
+            the changes of a DM are only applied once it has been delivered (see _notify_push)
+            the state is queued for writing only if it changed
+            return the delay before the next fetch in seconds
+        """
+        # get notifications preferences
+        logging.debug(f'[api/notifications] {member.nick} / {member}')
+        state = json.dumps(notifier["notifications"])
+        notifications = json.loads(state)
+
+        # get selections for Torn API call
+        keys = []
+        if "event" in notifications:
+            keys.append("events")
+            keys.append("notifications")
+        if "message" in notifications:
+            keys.append("messages")
+            keys.append("notifications")
+        if "award" in notifications:
+            keys.append("notifications")
+        if "energy" in notifications:
+            keys.append("bars")
+        if "nerve" in notifications:
+            keys.append("bars")
+        if "chain" in notifications:
+            keys.append("bars")
+        if "education" in notifications:
+            keys.append("education")
+        if "bank" in notifications:
+            keys.append("money")
+        if "drug" in notifications:
+            keys.append("cooldowns")
+        if "medical" in notifications:
+            keys.append("cooldowns")
+        if "booster" in notifications:
+            keys.append("cooldowns")
+        if "travel" in notifications:
+            keys.append("travel")
+
+        # make Torn API call
+        req = await self.bot.torn_api.get("user", "", list(set(keys)), notifier["key"])
+
+        if 'error' in req:
+            logging.warning(f'[api/notifications] {member.nick} / {member} error in api payload: {req["error"]["code"]}: {req["error"]["error"]}')
+            return NOTIFY_BASELINE
+
+        # notify event
+        if "event" in notifications:
+            if not req["notifications"]["events"]:
+                notifications["event"] = dict({})
+            else:
+                # loop over events
+                for k, v in req["events"].items():
+                    # if new event not notified -> notify
+                    if not v["seen"] and k not in notifications["event"]:
+                        self._notify_push(member, tId, cleanhtml(v["event"]).replace(" [View]", ""), "event", k, True)
+
+                    # if seen even already notified -> clean table
+                    elif v["seen"] and k in notifications["event"]:
+                        del notifications["event"][k]
+
+                notifications["event"] = self._notify_prune(notifications["event"], req["events"])
+
+        # notify message
+        if "message" in notifications:
+            if not req["notifications"]["messages"]:
+                notifications["message"] = dict({})
+            else:
+                # loop over messages
+                for k, v in req["messages"].items():
+                    # if new event not notified -> notify
+                    if not v["seen"] and k not in notifications["message"]:
+                        self._notify_push(member, tId, f'New message from {v["name"]}: {v["title"]}', "message", k, True)
+
+                    # if seen even already notified -> clean table
+                    elif v["seen"] and k in notifications["message"]:
+                        del notifications["message"][k]
+
+                notifications["message"] = self._notify_prune(notifications["message"], req["messages"])
+
+        # notify awards
+        if "award" in notifications:
+            if req["notifications"]["awards"]:
+                # if new award or different number of awards
+                if not notifications["award"].get("notified", False) or notifications["award"].get("notified") != req["notifications"]["awards"]:
+                    s = "s" if req["notifications"]["awards"] > 1 else ""
+                    self._notify_push(member, tId, f'You have {req["notifications"]["awards"]} new award{s}', "award", "notified", req["notifications"]["awards"])
+
+            else:
+                notifications["award"] = dict({})
+
+        # notify energy
+        if "energy" in notifications:
+            if req["energy"]["fulltime"] < 90:
+                if not notifications["energy"].get("notified", False):
+                    self._notify_push(member, tId, f'Energy at {req["energy"]["current"]} / {req["energy"]["maximum"]}', "energy", "notified", True)
+
+            else:
+                notifications["energy"] = dict({})
+
+        # notify nerve
+        if "nerve" in notifications:
+            if req["nerve"]["fulltime"] < 90:
+                if not notifications["nerve"].get("notified", False):
+                    self._notify_push(member, tId, f'Nerve at {req["nerve"]["current"]} / {req["nerve"]["maximum"]}', "nerve", "notified", True)
+
+            else:
+                notifications["nerve"] = dict({})
+
+        # notify chain
+        if "chain" in notifications:
+            if req["chain"]["timeout"] < 90 and req["chain"]["current"] > 10:
+                if not notifications["chain"].get("notified", False):
+                    self._notify_push(member, tId, f'Chain timeout in {req["chain"]["timeout"]} seconds', "chain", "notified", True)
+
+            else:
+                notifications["chain"] = dict({})
+
+        # notify education
+        if "education" in notifications:
+            if req["education_timeleft"] < 90:
+                if not notifications["education"].get("notified", False):
+                    self._notify_push(member, tId, f'Education ends in {req["education_timeleft"]} seconds', "education", "notified", True)
+
+            else:
+                notifications["education"] = dict({})
+
+        # notify bank
+        if "bank" in notifications:
+            if req["city_bank"]["time_left"] < 90:
+                if not notifications["bank"].get("notified", False):
+                    self._notify_push(member, tId, f'Bank investment ends in {req["city_bank"]["time_left"]} seconds (${req["city_bank"]["amount"]:,.0f})', "bank", "notified", True)
+
+            else:
+                notifications["bank"] = dict({})
+
+        # notify drug
+        if "drug" in notifications:
+            if req["cooldowns"]["drug"] < 90:
+                if not notifications["drug"].get("notified", False):
+                    self._notify_push(member, tId, f'Drug cooldown ends in {req["cooldowns"]["drug"]} seconds', "drug", "notified", True)
+
+            else:
+                notifications["drug"] = dict({})
+
+        # notify medical
+        if "medical" in notifications:
+            if req["cooldowns"]["medical"] < 90:
+                if not notifications["medical"].get("notified", False):
+                    self._notify_push(member, tId, f'Medical cooldown ends in {req["cooldowns"]["medical"]} seconds', "medical", "notified", True)
+
+            else:
+                notifications["medical"] = dict({})
+
+        # notify booster
+        if "booster" in notifications:
+            if req["cooldowns"]["booster"] < 90:
+                if not notifications["booster"].get("notified", False):
+                    self._notify_push(member, tId, f'Booster cooldown ends in {req["cooldowns"]["booster"]} seconds', "booster", "notified", True)
+
+            else:
+                notifications["booster"] = dict({})
+
+        # notify travel
+        if "travel" in notifications:
+            if req["travel"]["time_left"] < 90:
+                if not notifications["travel"].get("destination", False):
+                    self._notify_push(member, tId, f'Landing in {req["travel"]["destination"]} in {req["travel"]["time_left"]} seconds', "travel", None, req["travel"])
+                else:
+                    notifications["travel"] = req["travel"]
+
+            else:
+                notifications["travel"] = dict({})
+
+        # update notifications in YATA's database (written in batch at the end of the tick)
+        if json.dumps(notifications) != state:
+            notifier["notifications"] = notifications
+            self.notify_writes[tId] = json.dumps(notifications)
+
+        return self._notify_delay(notifications, req)
 
     @notify.before_loop
     async def before_notify(self):
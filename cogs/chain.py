@@ -19,8 +19,9 @@ This file is part of yata-bot.
 
 # import standard modules
 import asyncio
-import aiohttp
+import os
 import datetime
+import collections
 import json
 import re
 import logging
@@ -33,17 +34,53 @@ from discord.ext import tasks
 from discord import Embed
 
 # import bot functions and classes
-from inc.yata_db import set_configuration
+from inc.yata_db import get_yata_users
+from inc.metrics import get_task_metrics
 from inc.handy import *
 
+# chain watch: maximum number of member keys polled in turn and minimum sleep between two polls
+CHAIN_KEYS = 6
+CHAIN_MIN_SLEEP = 3
+
+# retal trackers: number of trackers running at the same time and maximum time of a tracker in seconds
+RETAL_CONCURRENCY = int(os.environ.get("RETAL_CONCURRENCY", 10))
+RETAL_TIMEOUT = int(os.environ.get("RETAL_TIMEOUT", 45))
+RETAL_SEEN = 1000  # attacks remembered per faction
+
+# retal polling cadence per faction in seconds: from the API cache interval while attacks keep coming in
+# up to RETAL_MAX_INTERVAL when nothing happens (the task ticks every RETAL_MIN_INTERVAL)
+RETAL_MIN_INTERVAL = 30
+RETAL_MAX_INTERVAL = int(os.environ.get("RETAL_MAX_INTERVAL", 240))
+
+
+def utc_ts():
+    """ current timestamp of the UTC clock whatever the timezone of the host (compared to the Torn timestamps)
+    """
+    now = datetime.datetime.utcnow()
+    epoch = datetime.datetime(1970, 1, 1, 0, 0, 0)
+    return int((now - epoch).total_seconds())
+
 
 class Chain(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.watches = dict({})  # faction id -> {"name", "subscribers": {channel id: subscriber}, "task", "wake"}
+        self.watching = dict({})  # channel id -> set of the watched faction ids
+        self.retal_semaphore = asyncio.Semaphore(RETAL_CONCURRENCY)
+        self.retal_turns = dict({})  # faction id -> turn of the key rotation
+        self.retal_checked = dict({})  # faction id -> last check of the faction of the keys
+        self.retal_seen = dict({})  # faction id -> (ring, set) of the attacks already processed
+        self.retal_marks = dict({})  # faction id -> API timestamp of the last attacks ingested (high-water mark)
+        self.retal_attackers = dict({})  # faction id -> {attacker id: {attack id: end of their attack on the faction}}
+        self.retal_metrics = get_task_metrics("retal", interval=RETAL_MIN_INTERVAL)
+        self.retal_schedule = dict({})  # faction id -> {"next": next poll, "interval": seconds, "last": last poll}
         self.retalTask.start()
 
     def cog_unload(self):
         self.retalTask.cancel()
+        for watch in self.watches.values():
+            if watch["task"] is not None:
+                watch["task"].cancel()
 
     @commands.command()
     @commands.bot_has_permissions(send_messages=True)
@@ -66,8 +103,6 @@ class Chain(commands.Cog):
             return
 
         # default values of the arguments
-        deltaW = 90  # warning timeout in seconds
-        deltaN = 600  # breathing messages every in second
         faction = ""  # use faction from key
         role = None
 
@@ -88,16 +123,7 @@ class Chain(commands.Cog):
         if status < 0:
             return
 
-        url = f'https://api.torn.com/faction/{faction}?selections=basic,chain&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                try:
-                    req = await r.json()
-                except BaseException:
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+        req = await self.bot.torn_api.get("faction", faction, "basic,chain", key)
 
         # handle API error
         if 'error' in req:
@@ -118,99 +144,256 @@ class Chain(commands.Cog):
             await ctx.send(f':x: `{factionName}` No chains on the horizon')
             return
 
+        # watch the faction chain (one poller per faction shared by all the channels)
+        self._watch(ctx.guild.id, ctx.channel.id, fId, factionName, role, ctx.author.id)
         if role is None:
             await ctx.send(f":chains: `{factionName}` Start watching")
         else:
             await ctx.send(f":chains: `{factionName}` Start watching. Will notify {role} on timeout.")
-        lastNotified = datetime.datetime(1970, 1, 1, 0, 0, 0)
-        while True:
-
-            # times needed
-            now = datetime.datetime.utcnow()
-            epoch = datetime.datetime(1970, 1, 1, 0, 0, 0)
-
-            # check if needs to notify still watching
-
-            # check last 50 messages for a stop --- had to do it not async to catch only 1 stop
-            history = await ctx.channel.history(limit=50).flatten()
-            for m in history:
-                if m.content in ["!stopchain", "!stop"]:
-                    await m.delete()
-                    await ctx.send(f":x: `{factionName}` Stop watching chain")
-                    return
-
-            # Initial call to get faction name
-            status, tornId, Name, key = await self.bot.get_user_key(ctx, ctx.author, needPerm=False)
-            if status < 0:
-                return
-
-            url = f'https://api.torn.com/faction/{fId}?selections=chain,timestamp&key={key}'
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as r:
-                    try:
-                        req = await r.json()
-                    except BaseException:
-                        req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-            if not isinstance(req, dict):
-                req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
 
-            # handle API error
-            if 'error' in req:
-                await ctx.send(f':x: `{factionName}` Master key problem: *{req["error"]["error"]}*')
-                return
+    def _watch(self, guild_id, channel_id, fId, factionName, role, user_id, save=True):
+        """ subscribes a channel to the chain watch of a faction
+            starts the faction poller if needed
+        """
+        fId = str(fId)
+        watch = self.watches.setdefault(fId, {"id": fId, "name": factionName, "subscribers": dict({}), "task": None, "wake": asyncio.Event()})
+        watch["name"] = factionName
+        watch["subscribers"][int(channel_id)] = {"guild": int(guild_id), "role": role, "user": int(user_id)}
+        self.watching.setdefault(int(channel_id), set()).add(fId)
+
+        if save:
+            config = self.bot.configurations.get(int(guild_id), {}).get("chain")
+            if isinstance(config, dict):
+                config.setdefault("watches", dict({}))[str(channel_id)] = {"faction": fId, "name": factionName, "role": role, "user": str(user_id)}
+                self.bot.configurations.mark_dirty(int(guild_id), "chain")
+
+        if watch["task"] is None or watch["task"].done():
+            watch["task"] = asyncio.get_event_loop().create_task(self._chain_poller(fId))
+        logging.debug(f'[chain/_watch] faction {fId}: {len(watch["subscribers"])} channels')
+
+    def _unwatch(self, fId, channel_id):
+        """ unsubscribes a channel from the chain watch of a faction
+            the poller is woken up and stops at once if it has no more subscribers
+        """
+        self.watching.get(int(channel_id), set()).discard(str(fId))
+        if not len(self.watching.get(int(channel_id), [None])):
+            del self.watching[int(channel_id)]
+
+        watch = self.watches.get(str(fId))
+        if watch is None:
+            return None
+
+        subscriber = watch["subscribers"].pop(int(channel_id), None)
+        self.bot.live.forget(int(channel_id), f'chain {fId}')
+        if not len(watch["subscribers"]):
+            watch["wake"].set()
+        if subscriber is not None:
+            config = self.bot.configurations.get(subscriber["guild"], {}).get("chain")
+            if isinstance(config, dict) and str(channel_id) in config.get("watches", {}):
+                del config["watches"][str(channel_id)]
+                self.bot.configurations.mark_dirty(subscriber["guild"], "chain")
+        return subscriber
+
+    async def _chain_key(self, watch):
+        """ gets a key from the subscribers of a watch (round robin)
+            return tornId, key or None, None
+        """
+        subscribers = list(watch["subscribers"].values())
+        for i in range(len(subscribers)):
+            subscriber = subscribers[(watch.get("turn", 0) + i) % len(subscribers)]
+            guild = self.bot.get_guild(subscriber["guild"])
+            member = None if guild is None else guild.get_member(subscriber["user"])
+            if member is None:
+                continue
+            status, tornId, Name, key = await self.bot.get_user_key(False, member, needPerm=False, guild=guild)
+            if status == 0:
+                watch["turn"] = watch.get("turn", 0) + i + 1
+                return tornId, key
 
-            # get timings
-            timeout = req.get("chain", dict({})).get("timeout", 0)
-            cooldown = req.get("chain", dict({})).get("cooldown", 0)
-            current = req.get("chain", dict({})).get("current", 0)
-            # timeout = 7
-            # cooldown = 0
-            # current = 10
+        return None, None
 
-            # get delay
-            nowts = (now - epoch).total_seconds()
-            apits = req.get("timestamp")
+    async def _chain_send(self, watch, message, mention=False, repost=False):
+        """ updates the live status message of the watch in all the subscribed channels
+            the message is posted again when the role is pinged (or when repost), otherwise it is edited in place
+        """
+        for channel_id, subscriber in list(watch["subscribers"].items()):
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            role = f'{subscriber["role"]} ' if mention and subscriber["role"] is not None else ''
+            try:
+                await self.bot.live.update(channel, f'chain {watch["id"]}', message.replace("{role}", role), repost=repost or len(role) > 0)
+            except BaseException as e:
+                logging.warning(f'[chain/_chain_send] {channel}: {hide_key(e)}')
 
-            delay = int(nowts - apits)
-            txtDelay = f"   *API caching delay of {delay}s*" if delay else ""
-            deltaLastNotified = int((now - lastNotified).total_seconds())
+    async def _chain_keys(self, fId, watch):
+        """ refreshes the keys of the faction members who gave their permission to the bot
+            (every 10 minutes, at most CHAIN_KEYS keys)
+        """
+        if utc_ts() - watch.get("keys_refreshed", 0) < 600:
+            return
+        watch["keys_refreshed"] = utc_ts()
 
-            # add delay to
-            # timeout -= delay
+        tornId, key = await self._chain_key(watch)
+        if key is None:
+            return
 
-            # if cooldown
-            if cooldown > 0:
-                await ctx.send(f':x: `{factionName}` Chain at **{current}** in cooldown for {cooldown/60:.1f}min   :cold_face:')
-                return
+        req = await self.bot.torn_api.get("faction", fId, "basic", key)
+        if "error" in req:
+            logging.warning(f'[chain/_chain_keys] {watch["name"]}: {req["error"]["error"]}')
+            return
 
-            # if timeout
-            elif timeout == 0:
-                await ctx.send(f':x: `{factionName}` Chain timed out   :rage:')
-                return
+        users = await get_yata_users(list(req.get("members", dict({}))), botPerm=True)
+        # keys dropped on an error stay out while they are sidelined
+        watch["keys"] = [(user["tId"], user["value"]) for user in users if self.bot.torn_api.key_healthy(user["value"])][:CHAIN_KEYS]
+        logging.debug(f'[chain/_chain_keys] {watch["name"]}: {len(watch["keys"])} member keys')
 
-            # if warning
-            elif timeout < deltaW:
-                if role is None:
-                    await ctx.send(f':chains: `{factionName}` Chain at **{current}** and timeout in **{timeout}s**{txtDelay}')
+    def _chain_member_key(self, watch):
+        """ next healthy member key of a watch (round robin)
+            return tornId, key or None, None
+        """
+        keys = watch.get("keys", [])
+        for i in range(len(keys)):
+            tornId, key = keys[(watch.get("key_turn", 0) + i) % len(keys)]
+            if self.bot.torn_api.key_healthy(key):
+                watch["key_turn"] = watch.get("key_turn", 0) + i + 1
+                return tornId, key
+
+        return None, None
+
+    async def _chain_poller(self, fId):
+        """ polls the chain of a faction and notifies all the subscribed channels
+            sleeps until the next warning window (at least 30s: the API caches the faction for 30s per key)
+            close to the timeout, the keys of the faction members are polled in turn (staggered)
+            so that the merged readings are fresher than the 30s cache of a single key
+        """
+        deltaW = 90  # warning timeout in seconds
+        deltaR = 10  # minimum delay between two warnings in seconds
+        watch = self.watches[fId]
+        watch["timestamp"] = 0  # timestamp of the freshest reading
+        watch["last_warned"] = 0
+        try:
+            while len(watch["subscribers"]):
+                factionName = watch["name"]
+
+                # get a member key or a key from the subscribers
+                await self._chain_keys(fId, watch)
+                tornId, key = self._chain_member_key(watch)
+                member_key = key is not None
+                if not member_key:
+                    tornId, key = await self._chain_key(watch)
+                if key is None:
+                    await self._chain_send(watch, f':x: `{factionName}` Could not get a key to watch the chain', repost=True)
+                    for channel_id in list(watch["subscribers"]):
+                        self._unwatch(fId, channel_id)
+                    break
+
+                # bypass the bot cache: each key has its own API cache
+                req = await self.bot.torn_api.get("faction", fId, "chain,timestamp", key, cache=False)
+
+                # handle API error (member keys are dropped, subscribers keys stop the watch)
+                if 'error' in req:
+                    if member_key:
+                        logging.warning(f'[chain/_chain_poller] {factionName}: drop member key [{tornId}]: {req["error"]["error"]}')
+                        watch["keys"] = [k for k in watch["keys"] if k[1] != key]
+                        # keep the staggering: the next key is not polled at once
+                        await asyncio.sleep(CHAIN_MIN_SLEEP)
+                        continue
+                    await self._chain_send(watch, f':x: `{factionName}` Key problem [{tornId}]: *{req["error"]["error"]}*', repost=True)
+                    for channel_id in list(watch["subscribers"]):
+                        self._unwatch(fId, channel_id)
+                    break
+
+                # dedupe readings: ignore responses older than the freshest one
+                nowts = utc_ts()
+                fresh = req.get("timestamp", nowts) > watch["timestamp"]
+                watch["timestamp"] = max(watch["timestamp"], req.get("timestamp", nowts))
+
+                # get timings
+                timeout = req.get("chain", dict({})).get("timeout", 0)
+                cooldown = req.get("chain", dict({})).get("cooldown", 0)
+                current = req.get("chain", dict({})).get("current", 0)
+
+                # get delay
+                delay = int(nowts - req.get("timestamp", nowts))
+                txtDelay = f"   *API caching delay of {delay}s*" if delay else ""
+                timeleft = max(0, timeout - delay)
+
+                # if cooldown, timeout or no chain: stop watching
+                stop = None
+                if not fresh:
+                    pass
+                elif cooldown > 0:
+                    stop = f':x: `{factionName}` Chain at **{current}** in cooldown for {cooldown/60:.1f}min   :cold_face:'
+                elif current == 0:
+                    stop = f':x: `{factionName}` No chains on the horizon'
+                elif timeout == 0:
+                    stop = f':x: `{factionName}` Chain timed out   :rage:'
+
+                if stop is not None:
+                    await self._chain_send(watch, stop, repost=True)
+                    for channel_id in list(watch["subscribers"]):
+                        self._unwatch(fId, channel_id)
+                    break
+
+                # if warning
+                if not fresh:
+                    pass
+                elif timeleft < deltaW:
+                    if nowts - watch["last_warned"] >= deltaR:
+                        watch["last_warned"] = nowts
+                        await self._chain_send(watch, f':chains: `{factionName}` {{role}}Chain at **{current}** and timeout in **{timeleft}s**{txtDelay}', mention=True)
+
+                # otherwise the status message is edited in place
                 else:
-                    await ctx.send(f':chains: `{factionName}` {role} Chain at **{current}** and timeout in **{timeout}s**{txtDelay}')
+                    await self._chain_send(watch, f':chains: `{factionName}` Chain at **{current}** and timeout in **{timeleft}s**{txtDelay}')
 
-            # if long enough for a notification
-            elif deltaLastNotified > deltaN:
-                lastNotified = now
-                await ctx.send(f':chains: `{factionName}` Chain at **{current}** and timeout in **{timeout}s**{txtDelay}')
-
-            # sleeps
-            # logging.info(timeout, deltaW, delay, 30 - delay)
-            sleep = max(30, timeout - deltaW)
-            logging.debug(f"[chain/chain] {ctx.guild} API delay of {delay} seconds, timeout of {timeout}: sleeping for {sleep} seconds")
-            await asyncio.sleep(sleep)
+                # sleeps until the warning window
+                # close to the timeout: staggered polls over the member keys
+                n_keys = max(1, len(watch.get("keys", [])))
+                if timeleft - 30 < deltaW and n_keys > 1:
+                    sleep = max(CHAIN_MIN_SLEEP, 30 / n_keys)
+                else:
+                    sleep = max(30, timeleft - deltaW)
+                logging.debug(f"[chain/_chain_poller] {factionName} API delay of {delay} seconds, timeout of {timeleft}: sleeping for {sleep} seconds")
+                # the sleep is interrupted when the last subscriber stops watching
+                try:
+                    await asyncio.wait_for(watch["wake"].wait(), sleep)
+                except asyncio.TimeoutError:
+                    pass
+                watch["wake"].clear()
+
+        except asyncio.CancelledError:
+            raise
+
+        except BaseException as e:
+            logging.error(f'[chain/_chain_poller] {watch["name"]}: {hide_key(e)}')
+            headers = {"faction": watch["name"], "error": "error on chain watch"}
+            await self.bot.send_log_main(e, headers=headers, full=True)
+
+        finally:
+            if self.watches.get(fId) is watch and not len(watch["subscribers"]):
+                del self.watches[fId]
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # restore the chain watches saved in the configurations
+        for guild in self.bot.get_guilds_by_module("chain"):
+            config = self.bot.get_guild_configuration_by_module(guild, "chain")
+            for channel_id, w in dict(config.get("watches", {})).items():
+                if w.get("faction") in self.watches and int(channel_id) in self.watches[w["faction"]]["subscribers"]:
+                    continue
+                logging.info(f'[chain/on_ready] {guild}: restore watch of {w.get("name")} in channel {channel_id}')
+                self._watch(guild.id, channel_id, w["faction"], w.get("name", f'Faction [{w["faction"]}]'), w.get("role"), w["user"], save=False)
 
-    @commands.command()
+    @commands.command(aliases=["stop"])
     @commands.bot_has_permissions(send_messages=True, manage_messages=True)
     @commands.guild_only()
-    async def stopchain(self, ctx):
+    async def stopchain(self, ctx, *args):
+        """ Stop watching chains in this channel
+            Use: !stopchain <factionId>
+                 factionId: torn id of the faction (by default all the factions watched in the channel)
+        """
         logging.info(f'[chain/stopchain] {ctx.guild}: {ctx.author.nick} / {ctx.author}')
 
         # get configuration
@@ -223,9 +406,26 @@ class Chain(commands.Cog):
         if not allowed:
             return
 
-        msg = await ctx.send("Gotcha! Just be patient, I'll stop watching on the next notification.")
-        await asyncio.sleep(10)
-        await msg.delete()
+        # watches of the channel
+        factions = list(self.watching.get(ctx.channel.id, []))
+        if len(args) and args[0].isdigit():
+            factions = [fId for fId in factions if fId == args[0]]
+
+        if not len(factions):
+            msg = await ctx.send(":x: No chains watched in this channel")
+            await asyncio.sleep(10)
+            await msg.delete()
+            return
+
+        for fId in factions:
+            factionName = self.watches[fId]["name"] if fId in self.watches else f'Faction [{fId}]'
+            self._unwatch(fId, ctx.channel.id)
+            await ctx.send(f":x: `{factionName}` Stop watching chain")
+
+        try:
+            await ctx.message.delete()
+        except BaseException:
+            pass
 
     @commands.command()
     @commands.bot_has_permissions(send_messages=True)
@@ -261,34 +461,21 @@ class Chain(commands.Cog):
         if status in [-1, -2]:
             return
 
-        # Torn API call
-        url = f'https://api.torn.com/faction/{factionId}?selections=basic&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                r = await r.json()
+        # faction snapshot
+        faction, err = await self.bot.factions.get(factionId, key)
 
-        if 'error' in r:
-            await ctx.send(f'Error code {r["error"]["code"]}: {r["error"]["error"]}')
+        if err is not None:
+            await ctx.send(f'Error code {err["code"]}: {err["error"]}')
             return
 
-        travels = {"Traveling": dict({}), "In": dict({}), "Returning": dict({})}
-        for k, v in r.get("members", dict({})).items():
-            if v["status"]["state"] in ["Traveling", "Abroad"]:
-                type = v["status"]["description"].split(" ")[0]
-                dest = v["status"]["description"].split(" ")[-1]
-                if dest in travels[type]:
-                    travels[type][dest].append(f'{v["name"]+":": <17} {v["status"]["description"]}')
-                else:
-                    travels[type][dest] = [f'{v["name"]+":": <17} {v["status"]["description"]}']
-
         dest = ["Mexico", "Islands", "Canada", "Hawaii", "Kingdom", "Argentina", "Switzerland", "Japan", "China", "UAE", "Africa"]
-        lst = [f'# {r["name"]} [{r["ID"]}]\n']
+        lst = [f'# {faction.name} [{faction.id}]\n']
         type = ["Returning", "In", "Traveling"]
         for t in type:
             for d in dest:
-                for m in travels[t].get(d, []):
-                    lst.append(m)
-            if len(travels[t]) and t != "Traveling":
+                for m in faction.destination(t, d):
+                    lst.append(f'{m["name"]+":": <17} {m["description"]}')
+            if len(faction.by_destination[t]) and t != "Traveling":
                 lst.append("---")
 
         await send_tt(ctx, lst)
@@ -327,31 +514,22 @@ class Chain(commands.Cog):
         if status in [-1, -2]:
             return
 
-        # Torn API call
-        url = f'https://api.torn.com/faction/{factionId}?selections=basic&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                r = await r.json()
+        # faction snapshot
+        faction, err = await self.bot.factions.get(factionId, key)
 
-        if 'error' in r:
-            await ctx.send(f':x: Error code {r["error"]["code"]}: {r["error"]["error"]}')
+        if err is not None:
+            await ctx.send(f':x: Error code {err["code"]}: {err["error"]}')
             return
 
-        if r["name"] is None:
+        if faction.name is None:
             await ctx.send(f':x: No faction with ID {factionId}')
             return
 
-        hosps = {}
-        for k, v in r.get("members", dict({})).items():
-            if v["status"]["state"] in ["Hospital"]:
-                s = v["status"]
-                a = v["last_action"]
-                hosps[k] = [v["name"], s["description"], cleanhtml(s["details"]), a["relative"], int(a["timestamp"])]
-
-        lst = [f'Members of **{r["name"]} [{r["ID"]}]** hospitalized: {len(hosps)}']
-        for k, v in sorted(hosps.items(), key=lambda x: -x[1][4]):
-            # line = f'**{v[0]}**: {v[1]} *{v[2]}* (last action {v[3]}) https://www.torn.com/profiles.php?XID={k}'
-            line = f'**{v[0]}**: {v[1]}, *last action {v[3]}*, https://www.torn.com/profiles.php?XID={k}'
+        members = faction.state("Hospital")
+        lst = [f'Members of **{faction.name} [{faction.id}]** hospitalized: {len(members)}']
+        for m in members:
+            # line = f'**{m["name"]}**: {m["description"]} *{m["details"]}* (last action {m["last_action"]}) https://www.torn.com/profiles.php?XID={m["id"]}'
+            line = f'**{m["name"]}**: {m["description"]}, *last action {m["last_action"]}*, https://www.torn.com/profiles.php?XID={m["id"]}'
             lst.append(line)
 
         await send_tt(ctx, lst, tt=False)
@@ -390,31 +568,22 @@ class Chain(commands.Cog):
         if status in [-1, -2]:
             return
 
-        # Torn API call
-        url = f'https://api.torn.com/faction/{factionId}?selections=basic&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                r = await r.json()
+        # faction snapshot
+        faction, err = await self.bot.factions.get(factionId, key)
 
-        if 'error' in r:
-            await ctx.send(f':x: Error code {r["error"]["code"]}: {r["error"]["error"]}')
+        if err is not None:
+            await ctx.send(f':x: Error code {err["code"]}: {err["error"]}')
             return
 
-        if r["name"] is None:
+        if faction.name is None:
             await ctx.send(f':x: No faction with ID {factionId}')
             return
 
-        hosps = {}
-        for k, v in r.get("members", dict({})).items():
-            if v["status"]["state"] in ["Okay"]:
-                s = v["status"]
-                a = v["last_action"]
-                hosps[k] = [v["name"], s["description"], cleanhtml(s["details"]), a["relative"], int(a["timestamp"])]
-
-        lst = [f'Members of **{r["name"]} [{r["ID"]}]** that are Okay: {len(hosps)}']
-        for k, v in sorted(hosps.items(), key=lambda x: -x[1][4]):
-            # line = f'**{v[0]}**: {v[1]} *{v[2]}* (last action {v[3]}) https://www.torn.com/profiles.php?XID={k}'
-            line = f'**{v[0]}**: {v[1]}, *last action {v[3]}*, https://www.torn.com/profiles.php?XID={k}'
+        members = faction.state("Okay")
+        lst = [f'Members of **{faction.name} [{faction.id}]** that are Okay: {len(members)}']
+        for m in members:
+            # line = f'**{m["name"]}**: {m["description"]} *{m["details"]}* (last action {m["last_action"]}) https://www.torn.com/profiles.php?XID={m["id"]}'
+            line = f'**{m["name"]}**: {m["description"]}, *last action {m["last_action"]}*, https://www.torn.com/profiles.php?XID={m["id"]}'
             lst.append(line)
 
         await send_tt(ctx, lst, tt=False)
@@ -465,30 +634,23 @@ class Chain(commands.Cog):
             await ctx.channel.send("```md\n# Vault\n< error > You need to enter a torn user ID: !vault <torn_id> or mention a member !vault @Mention```")
             return
 
-        url = f'https://api.torn.com/faction/?selections=basic,donations&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                try:
-                    req = await r.json()
-                except BaseException:
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+        req = await self.bot.torn_api.get("faction", "", "basic,donations", key)
 
         if 'error' in req:
             await ctx.send(f'```md\n# Vault\n< API error {req["error"]["code"]} > {req["error"]["error"]}```')
             return
 
-        factionName = f'{req["name"]} [{req["ID"]}]'
-        members = req["members"]
+        # the members table is shared with the other faction commands
+        faction = self.bot.factions.update(req, key=key)
+
+        factionName = f'{faction.name} [{faction.id}]'
         donations = req["donations"]
         checkVaultId = str(checkVaultId)
         lst = [f'Faction: {factionName}']
-        if checkVaultId in members:
-            member = members[checkVaultId]
+        if checkVaultId in faction.members:
+            member = faction.members[checkVaultId]
             lst.append(f'User: {member["name"]} [{checkVaultId}]')
-            lst.append(f'Action: {member["last_action"]["relative"]}')
+            lst.append(f'Action: {member["last_action"]}')
         else:
             lst.append(f'User: Member [{checkVaultId}]')
             lst.append(f'Action: Not in faction')
@@ -535,7 +697,7 @@ class Chain(commands.Cog):
             lst += ['', '<STOP>', "```"]
             await ctx.channel.send("\n".join(lst))
             del self.bot.configurations[ctx.guild.id]["chain"]["currents"][str(ctx.author.id)]
-            await set_configuration(self.bot.bot_id, ctx.guild.id, ctx.guild.name, self.bot.configurations[ctx.guild.id])
+            self.bot.configurations.mark_dirty(ctx.guild.id, "chain")
             return
 
         current = {"channel": [str(ctx.channel.id), f'{ctx.channel.name}', '#'],
@@ -564,87 +726,94 @@ class Chain(commands.Cog):
         lst += ['', '<START>', "```"]
         await ctx.channel.send("\n".join(lst))
         self.bot.configurations[ctx.guild.id]["chain"]["currents"][str(ctx.author.id)] = current
-        await set_configuration(self.bot.bot_id, ctx.guild.id, ctx.guild.name, self.bot.configurations[ctx.guild.id])
+        self.bot.configurations.mark_dirty(ctx.guild.id, "chain")
 
-    async def _retal(self, guild, retal):
+    async def _retal_channel(self, guild, retal):
+        """ checks a retal tracker
+            return the channel of the tracker or None if the tracker has to be stopped
+        """
 
         # get channel
         channelId = retal.get("channel")[0] if len(retal.get("channel", {})) else None
-        channel = get(guild.channels, id=int(channelId))
+        channel = None if channelId is None else guild.get_channel(int(channelId))
         if channel is None:
-            return False
+            return None
 
         # get discord member
         discord_id = retal.get("discord_user")[0] if len(retal.get("discord_user", {})) else "0"
-        discord_member = get(guild.members, id=int(discord_id))
+        discord_member = guild.get_member(int(discord_id))
         if discord_member is None:
             await channel.send(f'```md\n# Tracking retals\n< error > discord member {discord_member} not found\n\n<STOP>```')
-            return False
-
-        # get torn id, name and key
-        # # status, tornId, name, key = await self.bot.get_user_key(False, discord_member, guild=guild)
-        #
-        # if status < 0:
-        #     await channel.send(f'```md\n# Tracking retals\n< error > could not find torn identity of discord member {discord_member}```')
-        #     return False
+            return None
 
         if len(retal.get("torn_user")) < 4:
             await channel.send(f'```md\n# Tracking retals\n< error > Sorry it\'s my bad. I had to change how the tracking is built. You can launch it again now.\nKivou\n\n<STOP>```')
-            return False
+            return None
 
+        return channel
+
+    async def _retal_error(self, channel, retal, req):
+        """ reports an API error with the key of a tracker
+            return False if the tracker has to be stopped
+        """
         tornId = retal.get("torn_user")[0]
         name = retal.get("torn_user")[1]
-        key = retal.get("torn_user")[3]
 
-        roleId = retal.get("role")[0] if len(retal.get("role", {})) else None
-        notified = " " if roleId is None else f" <@&{roleId}> "
+        lst = [f'```md', f'# Tracking retals\n< error > Problem with {name} [{tornId}]\'s key: {req["error"]["error"]}']
+        if req["error"]["code"] in [7]:
+            lst.append("It means that you don't have the required AA permission (AA for API access) for this API request")
+            lst.append("This is an in-game permission that faction leader and co-leader can grant to their members")
 
-        url = f'https://api.torn.com/faction/?selections=basic,attacks&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                req = await r.json()
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        # handle API error
-        if 'error' in req:
-            lst = [f'```md', f'# Tracking retals\n< error > Problem with {name} [{tornId}]\'s key: {req["error"]["error"]}']
-            if req["error"]["code"] in [7]:
-                lst.append("It means that you don't have the required AA permission (AA for API access) for this API request")
-                lst.append("This is an in-game permission that faction leader and co-leader can grant to their members")
-
-            if req["error"]["code"] in [1, 2, 6, 7, 10]:
-                lst += ["", "<STOP>", "```"]
-                await channel.send("\n".join(lst))
-                return False
-            else:
-                lst += ["", "<CONTINUE>", "```"]
-                await channel.send("\n".join(lst))
-                return True
+        if req["error"]["code"] in [1, 2, 6, 7, 10]:
+            lst += ["", "<STOP>", "```"]
+            await channel.send("\n".join(lst))
+            return False
+        else:
+            lst += ["", "<CONTINUE>", "```"]
+            await channel.send("\n".join(lst))
+            return True
 
-        if req is None or "ID" not in req:
-            await channel.send(f'```md\n# Tracking retals\n< error > wrong API output\n\n{hide_key(req)}\n\n<CONTINUE>```')
+    def _retal_seen(self, fId, attack_id, mark=False):
+        """ checks if an attack of a faction has already been processed (and marks it if mark)
+            bounded per faction: only the last RETAL_SEEN attacks are remembered
+        """
+        ring, seen = self.retal_seen.setdefault(str(fId), (collections.deque(), set()))
+        if attack_id in seen:
             return True
 
-        if not int(req["ID"]):
-            await channel.send(f'```md\n# Tracking retals\n< error > no faction found for {name} {tornId}\n\n<STOP>```')
+        if mark:
+            ring.append(attack_id)
+            seen.add(attack_id)
+            if len(ring) > RETAL_SEEN:
+                seen.discard(ring.popleft())
+        return False
+
+    def _retal_candidate(self, fId, v, nowts):
+        """ attack from the light attacksfull selection that can be a retal or a retaliation
+            an outgoing attack can only be a retaliation on someone who attacked the faction in the 5 minutes before
+        """
+        delay = int(nowts - v["timestamp_ended"]) / float(60)
+        if delay >= 5:
             return False
+        if v["defender_faction"] == int(fId) and v["attacker_id"] and float(v.get("respect_gain", v.get("respect", 0))) > 0:
+            return True
+        if v["attacker_faction"] == int(fId):
+            # any attack of the defender ended in the 5 minutes before the hit (not only their last one)
+            attacked = self.retal_attackers.get(str(fId), dict({})).get(v["defender_id"], dict({}))
+            return any([0 <= v["timestamp_started"] - ended <= 300 for ended in attacked.values()])
+        return False
+
+    async def _retal(self, guild, channel, retal, fId, fName, attacks):
+        """ notifies a tracker of the retals in the new attacks of its faction
+            - attacks: {attack id: attack} full attacks (with names and modifiers) not processed yet
+        """
 
-        # faction id and name
-        fId = req["ID"]
-        fName = req["name"]
+        roleId = retal.get("role")[0] if len(retal.get("role", {})) else None
+        notified = " " if roleId is None else f" <@&{roleId}> "
 
-        now = datetime.datetime.utcnow()
-        epoch = datetime.datetime(1970, 1, 1, 0, 0, 0)
-        nowts = (now - epoch).total_seconds()
-        if "mentions" not in retal:
-            retal["mentions"] = []
-        for k, v in req["attacks"].items():
+        nowts = utc_ts()
+        for k, v in attacks.items():
             delay = int(nowts - v["timestamp_ended"]) / float(60)
-            if str(k) in retal["mentions"]:
-                # logging.debug(f"[chain/_retalTask] ignore mention #{k}")
-                continue
 
             if v["defender_faction"] == int(fId) and v["attacker_id"] and not float(v["modifiers"]["overseas"]) > 1 and float(v["respect_gain"]) > 0 and delay < 5:
                 tleft = 5 - delay
@@ -668,81 +837,221 @@ class Chain(commands.Cog):
                 embed.add_field(name=f'Log', value=f'[{v["result"]}](https://www.torn.com/loader.php?sid=attackLog&ID={v["code"]})')
 
                 await channel.send(message, embed=embed)
-                retal["mentions"].append(str(k))
 
             elif v["attacker_faction"] == int(fId) and float(v["modifiers"]["retaliation"]) > 1 and delay < 5:
                 attack_time = ts_to_datetime(int(v["timestamp_ended"]), fmt="time")
                 await channel.send(f':middle_finger: {v["attacker_name"]} retaled on **{v["defender_name"]} [{v["defender_id"]}]** {delay:.1f} minutes ago at {attack_time} TCT')
-                retal["mentions"].append(str(k))
 
-        # clean mentions
-        cleanedMentions = []
-        for k in retal["mentions"]:
-            if str(k) in req["attacks"]:
-                cleanedMentions.append(str(k))
+        return True
 
-        retal["mentions"] = cleanedMentions
+    async def _retal_faction(self, fId, trackers):
+        """ attacks fetched once for all the trackers of a faction, rotating over their keys
+            the attacks are ingested incrementally from the last attack seen (high-water mark)
+            only the new candidates are fetched with details and fanned out to every tracker channel
+            - trackers: list of (guild, discord user id, retal, channel)
 
-        # delete old messages
-        # fminutes = now - datetime.timedelta(minutes=5)
-        # async for message in channel.history(limit=50, before=fminutes):
-        #     if message.author.bot:
-        #         await message.delete()
+            return {tracker index: status} (True: continue, False: stop)
+        """
+        status = dict({})
+
+        # light attacks from the high-water mark (10 minutes for a new faction)
+        # the mark only moves on a successful poll: a slow or failed poll does not lose attacks
+        # the 5 minutes before the mark cover the attacks started earlier but still in progress at the last poll
+        # basic (faction id and name) only for new trackers or once an hour
+        since = self.retal_marks.get(fId, utc_ts() - 300) - 300
+        basic = not fId.isdigit() or utc_ts() - self.retal_checked.get(fId, 0) > 3600
+
+        # rotate over the keys of the trackers (next key on error)
+        # keys without budget left are used last
+        turn = self.retal_turns.get(fId, 0)
+        self.retal_turns[fId] = turn + 1
+        order = [(turn + i) % len(trackers) for i in range(len(trackers))]
+        order = sorted(order, key=lambda j: self.bot.torn_api.key_budget(trackers[j][2].get("torn_user")[3]) < 2)
+        req = None
+        for j in order:
+            guild, _, retal, channel = trackers[j]
+            key = retal.get("torn_user")[3]
+            req = await self.bot.torn_api.get("faction", "", "basic,timestamp,attacksfull" if basic else "timestamp,attacksfull", key, **{"from": since})
 
-        return True
+            # handle API error
+            if 'error' in req:
+                status[j] = await self._retal_error(channel, retal, req)
+                req = None
+                continue
 
-    @tasks.loop(seconds=60)
-    async def retalTask(self):
-        logging.debug("[chain/retal-notifications] start task")
+            if req is None or "attacks" not in req or (basic and "ID" not in req):
+                await channel.send(f'```md\n# Tracking retals\n< error > wrong API output\n\n{hide_key(req)}\n\n<CONTINUE>```')
+                req = None
+                continue
 
-        # iteration over all guilds
-        for guild in self.bot.get_guilds_by_module("chain"):
+            if basic and not int(req["ID"]):
+                await channel.send(f'```md\n# Tracking retals\n< error > no faction found for {retal.get("torn_user")[1]} {retal.get("torn_user")[0]}\n\n<STOP>```')
+                status[j] = False
+                req = None
+                continue
+
+            break
+
+        if req is None:
+            self._retal_reschedule(fId, False, polled=False)
+            return status
+
+        # faction of the trackers (checked once for the group and saved for every tracker)
+        if basic:
+            tracker_fId, fName = str(req["ID"]), html.unescape(req["name"])
+            self.retal_checked[tracker_fId] = utc_ts()
+            for guild, _, retal, channel in trackers:
+                if retal.get("faction", [])[:2] != [tracker_fId, fName]:
+                    retal["faction"] = [tracker_fId, fName, '']
+                    self.bot.configurations.mark_dirty(guild.id, "chain")
+        else:
+            tracker_fId, fName = trackers[0][2]["faction"][0], trackers[0][2]["faction"][1]
+
+        # high-water mark and attackers of the faction (to spot the retaliations)
+        nowts = utc_ts()
+        self.retal_marks[fId] = req.get("timestamp", nowts)
+        attackers = self.retal_attackers.setdefault(tracker_fId, dict({}))
+        # incoming attacks only, kept by attack: a later attack of the same player does not hide an earlier one
+        for k, v in req["attacks"].items():
+            if v["defender_faction"] == int(tracker_fId) and v["attacker_id"]:
+                attackers.setdefault(v["attacker_id"], dict({}))[str(k)] = v["timestamp_ended"]
+        for attacker, attacks in list(attackers.items()):
+            for k in [k for k, ended in attacks.items() if nowts - ended > 600]:
+                del attacks[k]
+            if not len(attacks):
+                del attackers[attacker]
+
+        # activity: attacks received since the last poll
+        last = self.retal_schedule.get(fId, {}).get("last", 0)
+        active = len([v for v in req["attacks"].values() if v["defender_faction"] == int(tracker_fId) and v["timestamp_ended"] > last]) > 0
+        self._retal_reschedule(fId, active)
+
+        # new candidates (details only for them: names and modifiers are not in attacksfull)
+        candidates = [k for k, v in req["attacks"].items() if self._retal_candidate(tracker_fId, v, nowts) and not self._retal_seen(tracker_fId, str(k))]
+        attacks = dict({})
+        if len(candidates):
+            started = min([req["attacks"][k]["timestamp_started"] for k in candidates])
+            details = await self.bot.torn_api.get("faction", "", "attacks", key, **{"from": started - 1})
+            if "error" in details:
+                logging.warning(f'[chain/_retal_faction] {fName}: attacks details error {details["error"]["error"]}')
+            attacks = {k: v for k, v in details.get("attacks", dict({})).items() if k in candidates}
+            for k in attacks:
+                self._retal_seen(tracker_fId, str(k), mark=True)
+            logging.debug(f'[chain/_retal_faction] {fName}: {len(candidates)} new candidates, {len(attacks)} with details')
+
+        # fan out (also to the trackers whose key failed with a retryable error)
+        # the channels are sent to concurrently: a slow or rate limited channel does not delay the others
+        fan_out = [j for j in range(len(trackers)) if status.get(j) is not False]
+        if not len(attacks):
+            status.update({j: True for j in fan_out})
+            return status
+
+        sent = await asyncio.gather(*[self._retal(trackers[j][0], trackers[j][3], trackers[j][2], tracker_fId, fName, attacks) for j in fan_out], return_exceptions=True)
+        for j, r in zip(fan_out, sent):
+            if isinstance(r, BaseException):
+                guild, _, _, channel = trackers[j]
+                logging.warning(f'[chain/_retal_faction] {guild} [{guild.id}] #{channel}: {hide_key(r)}')
+                r = True
+            status[j] = r
+
+        return status
+
+    async def _retal_job(self, fId, trackers):
+        """ runs the trackers of a faction (bounded concurrency and time)
+            return {tracker index: status}
+        """
+        async with self.retal_semaphore:
             try:
+                return await asyncio.wait_for(self._retal_faction(fId, trackers), RETAL_TIMEOUT)
 
-                config = self.bot.get_guild_configuration_by_module(guild, "chain", check_key="currents")
-                if not config:
-                    logging.debug(f"[chain/retal-notifications] No retal for {guild}")
-                    continue
-                logging.debug(f"[chain/retal-notifications] retal for {guild}")
-
-                # iteration over all members asking for retal watch
-                # guild = self.bot.get_guild(guild.id)
-                todel = []
-                tochange = {}
-                for discord_user_id, retal in config["currents"].items():
-                    # logging.debug(f"[chain/retal-notifications] {guild}: {retal}")
-
-                    # call retal faction
-                    previous_mentions = list(retal.get("mentions", []))
-                    status = await self._retal(guild, retal)
-
-                    # update metionned messages (but don't save in database, will remention in case of reboot)
-                    if status and previous_mentions != retal.get("mentions", []):
-                        tochange[discord_user_id] = retal
-                    elif not status:
-                        todel.append(discord_user_id)
-
-                changes = False
-                for d in todel:
-                    del self.bot.configurations[guild.id]["chain"]["currents"][d]
-                    changes = True
-
-                for discord_user_id, retal in tochange.items():
-                    self.bot.configurations[guild.id]["chain"]["currents"][discord_user_id] = retal
-                    changes = True
-
-                if changes:
-                    await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
-                    logging.debug(f"[chain/retal-notifications] push notifications for {guild}")
-                else:
-                    logging.debug(f"[chain/retal-notifications] don't push notifications for {guild}")
+            except asyncio.TimeoutError:
+                self.retal_metrics.timeouts += 1
+                logging.warning(f'[chain/retal-notifications] faction {fId}: {len(trackers)} trackers timed out after {RETAL_TIMEOUT}s')
 
             except BaseException as e:
-                logging.error(f'[chain/retal-notifications] {guild} [{guild.id}]: {hide_key(e)}')
+                self.retal_metrics.errors += 1
+                guild = trackers[0][0]
+                logging.error(f'[chain/retal-notifications] {guild} [{guild.id}] faction {fId}: {hide_key(e)}')
                 await self.bot.send_log(e, guild_id=guild.id)
-                headers = {"guild": guild, "guild_id": guild.id, "error": "error on retal task"}
+                headers = {"guild": guild, "guild_id": guild.id, "faction": fId, "error": "error on retal task"}
                 await self.bot.send_log_main(e, headers=headers, full=True)
 
+        return dict({})
+
+    def _retal_reschedule(self, fId, active, polled=True):
+        """ next poll of a faction: as soon as possible while attacks keep coming in, slower and slower otherwise
+        """
+        now = utc_ts()
+        schedule = self.retal_schedule.setdefault(fId, {"next": 0, "interval": 60, "last": now - 600})
+        if active:
+            schedule["interval"] = RETAL_MIN_INTERVAL
+        elif polled:
+            schedule["interval"] = min(RETAL_MAX_INTERVAL, schedule["interval"] * 2)
+        if polled:
+            schedule["last"] = now
+        # 5 seconds slack to be polled on the tick
+        schedule["next"] = now + schedule["interval"] - 5
+        logging.debug(f'[chain/retal-notifications] faction {fId}: next poll in {schedule["interval"]}s{" (active)" if active else ""}')
+
+    @tasks.loop(seconds=RETAL_MIN_INTERVAL)
+    async def retalTask(self):
+        logging.debug("[chain/retal-notifications] start task")
+        self.retal_metrics.start()
+
+        # group the trackers of all guilds by faction
+        # trackers with an unknown faction (new ones) are on their own until the first fetch
+        groups = dict({})
+        n = 0
+        for guild in self.bot.get_guilds_by_module("chain"):
+            config = self.bot.get_guild_configuration_by_module(guild, "chain", check_key="currents")
+            if not config:
+                logging.debug(f"[chain/retal-notifications] No retal for {guild}")
+                continue
+            logging.debug(f"[chain/retal-notifications] retal for {guild}")
+
+            for discord_user_id, retal in list(config["currents"].items()):
+                channel = await self._retal_channel(guild, retal)
+                if channel is None:
+                    del config["currents"][discord_user_id]
+                    self.bot.configurations.mark_dirty(guild.id, "chain")
+                    continue
+
+                # mentions are not stored anymore (attacks seen are kept in memory)
+                if "mentions" in retal:
+                    del retal["mentions"]
+                    self.bot.configurations.mark_dirty(guild.id, "chain")
+
+                fId = retal.get("faction", [None])[0]
+                group = f'{fId}' if fId else f'key {retal.get("torn_user")[0]}'
+                groups.setdefault(group, []).append((guild, discord_user_id, retal, channel))
+                n += 1
+
+        # forget the factions without trackers
+        for group in [g for g in self.retal_schedule if g not in groups]:
+            del self.retal_schedule[group]
+            self.retal_marks.pop(group, None)
+
+        # factions due to be polled
+        groups = {group: trackers for group, trackers in groups.items() if self.retal_schedule.get(group, {}).get("next", 0) <= utc_ts()}
+        n = sum([len(trackers) for trackers in groups.values()])
+
+        # one fetch per faction, factions run concurrently
+        status = await asyncio.gather(*[self._retal_job(group, trackers) for group, trackers in groups.items()])
+
+        # remove stopped trackers
+        for (group, trackers), group_status in zip(groups.items(), status):
+            for j, (guild, discord_user_id, retal, channel) in enumerate(trackers):
+                currents = self.bot.configurations.get(guild.id, {}).get("chain", {}).get("currents", {})
+                if group_status.get(j) is False and discord_user_id in currents:
+                    del currents[discord_user_id]
+                    self.bot.configurations.mark_dirty(guild.id, "chain")
+
+        duration = self.retal_metrics.stop(jobs=n)
+        if duration > self.retal_metrics.interval:
+            logging.warning(f'[chain/retal-notifications] tick overrun: {n} trackers of {len(groups)} factions in {duration:.1f}s')
+        else:
+            logging.debug(f'[chain/retal-notifications] {n} trackers of {len(groups)} factions in {duration:.1f}s')
+
     @retalTask.before_loop
     async def before_retalTask(self):
         await self.bot.wait_until_ready()
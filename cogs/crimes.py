@@ -19,7 +19,6 @@ This file is part of yata-bot.
 
 # import standard modules
 import asyncio
-import aiohttp
 import datetime
 import json
 import re
@@ -32,7 +31,6 @@ from discord.utils import get
 from discord.ext import tasks
 
 # import bot functions and classes
-from inc.yata_db import set_configuration
 from inc.handy import *
 
 
@@ -68,16 +66,7 @@ class Crimes(commands.Cog):
             return
 
         # make api call
-        url = f"https://api.torn.com/faction/?selections=basic,crimes&key={key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                try:
-                    req = await r.json()
-                except BaseException:
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+        req = await self.bot.torn_api.get("faction", "", "basic,crimes", key)
 
         # handle API error
         if "error" in req:
@@ -132,7 +121,7 @@ class Crimes(commands.Cog):
             lst += ['', '<STOP>', "```"]
             await ctx.channel.send("\n".join(lst))
             del self.bot.configurations[ctx.guild.id]["oc"]["currents"][str(ctx.author.id)]
-            await set_configuration(self.bot.bot_id, ctx.guild.id, ctx.guild.name, self.bot.configurations[ctx.guild.id])
+            self.bot.configurations.mark_dirty(ctx.guild.id, "oc")
             return
 
         current = {"channel": [str(ctx.channel.id), f'{ctx.channel.name}', '#'],
@@ -161,7 +150,7 @@ class Crimes(commands.Cog):
         lst += ['', '<START>', "```"]
         await ctx.channel.send("\n".join(lst))
         self.bot.configurations[ctx.guild.id]["oc"]["currents"][str(ctx.author.id)] = current
-        await set_configuration(self.bot.bot_id, ctx.guild.id, ctx.guild.name, self.bot.configurations[ctx.guild.id])
+        self.bot.configurations.mark_dirty(ctx.guild.id, "oc")
 
     async def _oc(self, guild, oc):
 
@@ -196,16 +185,7 @@ class Crimes(commands.Cog):
         roleId = oc.get("role")[0] if len(oc.get("role", {})) else None
         notified = "**OC Tracking**\n" if roleId is None else f"<@&{roleId}>\n"
 
-        url = f'https://api.torn.com/faction/?selections=basic,crimes&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                try:
-                    req = await r.json()
-                except BaseException:
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+        req = await self.bot.torn_api.get("faction", "", "basic,crimes", key)
 
         # handle API error
         if 'error' in req:
@@ -357,7 +337,7 @@ class Crimes(commands.Cog):
                     changes = True
 
                 if changes:
-                    await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
+                    self.bot.configurations.mark_dirty(guild.id, "oc")
                     logging.debug(f"[oc/notifications] <{guild}> push notifications")
                 else:
                     logging.debug(f"[oc/notifications] <{guild}> don't push notifications")
@@ -40,6 +40,7 @@ from inc.handy import *
 class Loot(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.alerted = dict({})  # (guild id, npc id) -> (channel id, loot level IV timestamp, level, due) of the last alert
         self.notify.start()
 
     def cog_unload(self):
@@ -97,14 +98,13 @@ class Loot(commands.Cog):
 
             msg.append(" ".join(line))
 
-        await ctx.send("```ARM\n{}```".format("\n".join(msg)))
+        # post the report and delete the previous one (looked up in the history only after a restart)
+        await self.bot.live.adopt(ctx.channel, "loot", self.botMessages)
+        await self.bot.live.update(ctx.channel, "loot", "```ARM\n{}```".format("\n".join(msg)), repost=True)
 
         # clean messages
         await ctx.message.delete()
 
-        async for m in ctx.channel.history(limit=10, before=ctx.message).filter(self.botMessages):
-            await m.delete()
-
     @tasks.loop(seconds=5)
     async def notify(self):
         logging.debug("[loot/notifications] start task")
@@ -131,6 +131,7 @@ class Loot(commands.Cog):
         # loop over NPCs
         mentions = []
         embeds = []
+        alerts = []
         nextDue = []
         for id, npc in req.items():
             lvl = npc["levels"]["current"]
@@ -157,6 +158,7 @@ class Loot(commands.Cog):
                 embed.set_thumbnail(url=url)
                 embed.set_footer(text='Items to loot: {}'.format(', '.join(items.get(id, ["Nice things"]))))
                 embeds.append(embed)
+                alerts.append((id, ts, lvl, due <= 0))
                 logging.debug(f'[loot/notifications] {npc["name"]}: notify (due {due})')
             elif due > 0:
                 # used for computing sleeping time
@@ -180,17 +182,31 @@ class Loot(commands.Cog):
                     continue
 
                 # get role & channel
-                role = self.bot.get_module_role(guild.roles, config.get("roles_alerts", {}))
-                channel = self.bot.get_module_channel(guild.channels, config.get("channels_alerts", {}))
+                role = self.bot.get_guild_module_role(guild, "loot", "roles_alerts")
+                channel = self.bot.get_guild_module_channel(guild, "loot", "channels_alerts")
 
                 if channel is None:
                     continue
 
-                # loop of npcs to mentions
-                for m, e in zip(mentions, embeds):
+                # one live alert per npc and guild
+                # posted with a ping when the npc enters the window (or the channel changed) and again when the loot is due
+                # edited in between only when the level changes
+                for (id, ts, lvl, now), m, e in zip(alerts, mentions, embeds):
+                    last = self.alerted.get((guild.id, id))
+                    ping = last is None or last[:2] != (channel.id, ts) or not self.bot.live.tracked(channel.id, f'npc {id}')
+                    ping = ping or (now and not last[3])
+                    if not ping and last[2:] == (lvl, now):
+                        continue
                     logging.debug(f"[LOOT] guild {guild}: mention {m}.")
                     msg = f'Go for {m}' if role is None else f'{role.mention}, go for {m}'
-                    await channel.send(msg, embed=e)
+                    await self.bot.live.update(channel, f'npc {id}', msg, embed=e, repost=ping)
+                    self.alerted[(guild.id, id)] = (channel.id, ts, lvl, now)
+
+                # stop tracking the alerts of the npcs out of the window
+                for id in req:
+                    if id not in [a[0] for a in alerts]:
+                        self.bot.live.forget(channel.id, f'npc {id}')
+                        self.alerted.pop((guild.id, id), None)
 
             except BaseException as e:
                 logging.error(f'[loot/notifications] {guild} [{guild.id}]: {hide_key(e)}')
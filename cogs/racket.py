@@ -19,7 +19,6 @@ This file is part of yata-bot.
 
 # import standard modules
 import asyncio
-import aiohttp
 import datetime
 import json
 import re
@@ -53,21 +52,12 @@ class Racket(commands.Cog):
 
         guild = self.bot.get_guild(self.bot.main_server_id)
         _, _, key = await self.bot.get_master_key(guild)
-        url = f'https://api.torn.com/torn/?selections=rackets,territory,timestamp&key={key}'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                try:
-                    req = await r.json()
-                except BaseException:
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-        if not isinstance(req, dict):
-            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+        req = await self.bot.torn_api.get("torn", "", "rackets,territory,timestamp", key)
 
         if "error" in req:
             return
 
-        timestamp_p, randt_p = get_data(self.bot.bot_id, "rackets")
+        timestamp_p, randt_p = await get_data(self.bot.bot_id, "rackets")
         rackets_p = randt_p["rackets"]
         territory_p = randt_p["territory"]
 
@@ -174,8 +164,8 @@ class Racket(commands.Cog):
                     continue
 
                 # get role & channel
-                role = self.bot.get_module_role(guild.roles, config.get("roles_alerts", {}))
-                channel = self.bot.get_module_channel(guild.channels, config.get("channels_alerts", {}))
+                role = self.bot.get_guild_module_role(guild, "rackets", "roles_alerts")
+                channel = self.bot.get_guild_module_channel(guild, "rackets", "channels_alerts")
 
                 if channel is None:
                     continue
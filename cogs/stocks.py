@@ -65,7 +65,7 @@ class Stocks(commands.Cog):
         # list all users
         stockOwners = []
         timeLeft = dict()
-        role = self.bot.get_module_role(ctx.guild.roles, config.get(f"roles_{stock}", {}))
+        role = self.bot.get_guild_module_role(ctx.guild, "stocks", f"roles_{stock}")
         if role is None:
             await ctx.send(f"```md\n# Stock module: shared {stock.upper()} bonus block\n< error > no roles attributed to {stock}```")
             return [], None
@@ -77,16 +77,7 @@ class Stocks(commands.Cog):
                 continue
 
             # get information from API key
-            url = f'https://api.torn.com/user/?selections={so.get(stock)[0]},stocks,discord,timestamp&key={key}'
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as r:
-                    try:
-                        req = await r.json()
-                    except BaseException:
-                        req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-            if not isinstance(req, dict):
-                req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+            req = await self.bot.torn_api.get("user", "", [so.get(stock)[0], "stocks", "discord", "timestamp"], key)
 
             # deal with api error
             if "error" in req:
@@ -167,7 +158,7 @@ class Stocks(commands.Cog):
     async def notify(self):
         logging.debug(f"[stock/notify] start task")
 
-        _, mentions_keys_prev = get_data(self.bot.bot_id, "stocks")
+        _, mentions_keys_prev = await get_data(self.bot.bot_id, "stocks")
         mentions_keys = []
         mentions = []
         try:
@@ -288,8 +279,8 @@ class Stocks(commands.Cog):
                 continue
 
             # get role & channel
-            role = self.bot.get_module_role(guild.roles, config.get("roles_alerts", {}))
-            channel = self.bot.get_module_channel(guild.channels, config.get("channels_alerts", {}))
+            role = self.bot.get_guild_module_role(guild, "stocks", "roles_alerts")
+            channel = self.bot.get_guild_module_channel(guild, "stocks", "channels_alerts")
 
             if channel is None:
                 continue
@@ -18,7 +18,8 @@ This file is part of yata-bot.
 """
 # import standard modules
 import re
-import aiohttp
+import os
+import io
 import asyncio
 import html
 import traceback
@@ -29,12 +30,16 @@ from discord.ext import commands
 from discord.abc import PrivateChannel
 from discord.utils import get
 from discord.ext import tasks
+from discord import File
 
 # import bot functions and classes
-from inc.yata_db import set_configuration
 from inc.yata_db import get_faction_name
 from inc.handy import *
 
+# bulk verification: number of members resolved (API calls) and updated (discord calls) at the same time
+VERIFY_CONCURRENCY = int(os.environ.get("VERIFY_CONCURRENCY", 10))
+VERIFY_APPLY_CONCURRENCY = int(os.environ.get("VERIFY_APPLY_CONCURRENCY", 5))
+
 
 class Verify(commands.Cog):
     def __init__(self, bot):
@@ -70,13 +75,13 @@ class Verify(commands.Cog):
             return
 
         # verify member when he join
-        role = self.bot.get_module_role(member.guild.roles, config.get("roles_verified", {}))
+        role = self.bot.get_guild_module_role(member.guild, "verify", "roles_verified")
         if role is None:
             return
         message, success = await self._member(member, role, discordID=member.id, API_KEY=key, context=False)
 
         # send message to welcome channel
-        channel = self.bot.get_module_channel(member.guild.channels, config.get("channels_welcome", {}))
+        channel = self.bot.get_guild_module_channel(member.guild, "verify", "channels_welcome")
         if channel is None:
             return
         await channel.send(f'```md\n# Verify\n {message}```')
@@ -118,7 +123,7 @@ class Verify(commands.Cog):
             return
 
         # Get Verified role
-        role = self.bot.get_module_role(ctx.guild.roles, config.get("roles_verified", {}))
+        role = self.bot.get_guild_module_role(ctx.guild, "verify", "roles_verified")
         if role is None:
             await ctx.send('```md\n# verify\n< error > No verified role given```')
             return
@@ -328,16 +333,7 @@ class Verify(commands.Cog):
             # case no userID and no discordID is given (author verify itself)
             if author_verif:
                 author = ctx.author
-                url = f"https://api.torn.com/user/{author.id}?selections=discord&key={API_KEY}"
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as r:
-                        try:
-                            req = await r.json()
-                        except BaseException:
-                            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-                if not isinstance(req, dict):
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+                req = await self.bot.torn_api.get("user", author.id, "discord", API_KEY)
 
                 if 'error' in req:
                     return "< error > There is an API key problem ({}).".format(req['error']['error']), False
@@ -348,16 +344,7 @@ class Verify(commands.Cog):
             # case discordID is given
             # if discordID is not None and userID is None:  # use this condition to skip API call if userID is given
             if discordID is not None:  # use this condition to force API call to check userID even if it is given
-                url = f"https://api.torn.com/user/{discordID}?selections=discord&key={API_KEY}"
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as r:
-                        try:
-                            req = await r.json()
-                        except BaseException:
-                            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-                if not isinstance(req, dict):
-                    req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+                req = await self.bot.torn_api.get("user", discordID, "discord", API_KEY)
 
                 if 'error' in req:
                     return ":x: There is an API key problem ({}).".format(req['error']['error']), False
@@ -369,16 +356,7 @@ class Verify(commands.Cog):
             logging.info(f"[verify/_member] verifying userID = {userID}")
 
             # api call request
-            url = f"https://api.torn.com/user/{userID}?selections=profile,discord&key={API_KEY}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as r:
-                    try:
-                        req = await r.json()
-                    except BaseException:
-                        req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-            if not isinstance(req, dict):
-                req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+            req = await self.bot.torn_api.get("user", userID, "profile,discord", API_KEY)
 
             # check api error
             if 'error' in req:
@@ -440,6 +418,7 @@ class Verify(commands.Cog):
                         logging.error(f'[verify/_member] {guild} [{guild.id}]: positions {hide_key(e)}')
 
                 nl = '\n- '
+                self.bot.invalidate_identity(author.id)
                 return f'< {author} >\nYou have been verified and are now known as < {author.display_name} >. You have been given the role{"s" if len(roles_list)>1 else ""}:{nl}{nl.join(roles_list)}', True
 
             else:
@@ -482,6 +461,7 @@ class Verify(commands.Cog):
                                 logging.error(f'[verify/_member] {guild} [{guild.id}]: positions {hide_key(e)}')
 
                         nl = '\n- '
+                        self.bot.invalidate_identity(member.id)
                         return f'< {member} >\nThey have been verified and are now known as < {member.display_name} >. They have been given the role{"s" if len(roles_list)>1 else ""}:{nl}{nl.join(roles_list)}', True
 
                 # if no match in this loop it means that the member is not in this server
@@ -493,7 +473,104 @@ class Verify(commands.Cog):
 
         return "< error > Weird... I didn't do anything...", False
 
+    async def _verify_resolve(self, guild, member):
+        """ resolves the torn profile of a member (discord id -> torn id -> profile)
+            return {"member", "error"} (with the messages of _member) or {"member", "userID", "name", "faction"}
+        """
+        # spread the calls over all the master keys of the guild
+        status, tornId, key = await self.bot.get_master_key(guild)
+        if status == -1:
+            return {"member": member, "error": "< error > no master key"}
+
+        req = await self.bot.torn_api.get("user", member.id, "discord", key)
+        if 'error' in req:
+            return {"member": member, "error": ":x: There is an API key problem ({}).".format(req['error']['error'])}
+        userID = req['discord'].get("userID")
+        if userID == '':
+            return {"member": member, "error": f"{member} is not officially verified by Torn"}
+        userID = int(userID)
+
+        req = await self.bot.torn_api.get("user", userID, "profile,discord", key)
+        if 'error' in req:
+            if int(req['error']['code']) == 6:
+                return {"member": member, "error": f"< error > Torn ID {userID} is not known. Please check again."}
+            return {"member": member, "error": "< error > There is a API key problem ({}).".format(req['error']['error'])}
+
+        dis = req.get("discord", dict({}))
+        if int(dis.get("userID")) != userID:
+            return {"member": member, "error": "< error >  That's odd... {} != {}.".format(userID, dis.get("userID"))}
+        nickname = f'{req.get("name", "???")} [{userID}]'
+        if dis.get("discordID") in ['']:
+            return {"member": member, "error": f"{nickname} is not officially verified by Torn"}
+        if str(dis.get("discordID")) != str(member.id):
+            return {"member": member, "error": f"You are trying to verify < {nickname} > but they didn't join this server... Maybe they are using a different discord account on the official Torn discord server."}
+
+        return {"member": member, "userID": int(userID), "name": req.get("name", "???"), "faction": req.get("faction", dict({}))}
+
+    async def _verify_plan(self, guild, config, role, resolved, position_roles):
+        """ computes the nickname and the roles of a resolved member
+            the missing position roles are created (position_roles: name -> role shared by all the members)
+            return {"member", "nick", "add", "remove"}
+        """
+        member = resolved["member"]
+        roles = [role]
+
+        # faction roles
+        fId = str(resolved["faction"].get("faction_id"))
+        fNa = html.unescape(str(resolved["faction"].get("faction_name")))
+        faction_roles_id = config.get("factions", {}).get(fId, {})
+        roles += [_ for _ in self.bot.get_module_role(guild.roles, faction_roles_id, all=True) if _ is not None]
+
+        # position role (and removal of the other positions in the faction)
+        remove = []
+        if fId in config.get("factions", {}) and fId in config.get("positions", {}):
+            position_name = f'{html.unescape(str(resolved["faction"].get("position")))} of {fNa}'
+            if position_name not in position_roles:
+                position_roles[position_name] = get(guild.roles, name=position_name)
+                if position_roles[position_name] is None:
+                    position_roles[position_name] = await guild.create_role(name=position_name)
+            roles.append(position_roles[position_name])
+            remove = [r for r in member.roles if " of " in r.name and r.name.split(" of ")[-1] == fNa and r.name != position_name]
+
+        return {
+            "member": member,
+            "userID": resolved["userID"],
+            "nick": f'{resolved["name"]} [{resolved["userID"]}]',
+            "add": [r for r in roles if r not in member.roles],
+            "remove": remove}
+
+    async def _verify_apply(self, plan):
+        """ applies the nickname and the roles of a plan (only the changes)
+            return the line of the report
+        """
+        member = plan["member"]
+        if member.nick != plan["nick"]:
+            try:
+                await member.edit(nick=plan["nick"])
+            except BaseException:
+                pass
+        if len(plan["remove"]):
+            await member.remove_roles(*plan["remove"])
+        if len(plan["add"]):
+            await member.add_roles(*plan["add"])
+
+        # the cached identity is only stale if the member is now someone else
+        identity = self.bot.identities.get(member.id)
+        if identity is not None and identity[1] != plan["userID"]:
+            self.bot.invalidate_identity(member.id)
+
+        if len(plan["add"]) or len(plan["remove"]):
+            changes = [f'+@{html.unescape(r.name)}' for r in plan["add"]] + [f'-@{html.unescape(r.name)}' for r in plan["remove"]]
+            return f'verified as {plan["nick"]}: {" ".join(changes)}'
+        return f'verified as {plan["nick"]}: no role changes'
+
     async def _loop_verify(self, guild, channel, ctx=False, force=False):
+        """ verifies all the members of a guild (or only the ones without the verified role if not force)
+            1. resolves the torn profiles concurrently (within the rate limits of the master keys)
+            2. plans the nicknames and roles changes
+            3. applies the changes with a bounded concurrency
+            the progress is edited in one message and the full report is attached at the end
+        """
 
         # get configuration
         config = self.bot.get_guild_configuration_by_module(guild, "verify")
@@ -507,40 +584,71 @@ class Verify(commands.Cog):
             return
 
         # Get Verified role
-        role = self.bot.get_module_role(guild.roles, config.get("roles_verified", {}))
+        role = self.bot.get_guild_module_role(guild, "verify", "roles_verified")
         if role is None:
             await channel.send(f'```md\n# Verifying all members of {guild}\n< Force > {force}\n< error > no verified roles set```')
             return
 
-        await channel.send(f'```md\n# Verifying all members of {guild}\n< Force > {force}\n< Verified role > @{role}```')
+        members = [m for m in guild.members if not m.bot and (force or role not in m.roles)]
+        header = f'# Verifying all members of {guild}\n< Force > {force}\n< Verified role > @{role}\n< Members > {len(members)}'
+        topic = f'verify {guild.id}'
+        progress = {"resolved": 0, "applied": 0, "errors": 0}
 
-        # loop over members
-        members = guild.members
-        for i, member in enumerate(members):
-            if member.bot:
-                continue
+        async def report(step, repost=False):
+            lines = [header] + [f'< {k} > {v}/{len(members)}' if k != "errors" else f'< {k} > {v}' for k, v in progress.items()] + [f'# {step}']
+            await self.bot.live.update(channel, topic, "```md\n{}```".format("\n".join(lines)), repost=repost)
 
-            if force:
-                if ctx:
-                    message, _ = await self._member(ctx, role, discordID=member.id, API_KEY=key)
-                else:
-                    message, _ = await self._member(member, role, discordID=member.id, API_KEY=key, context=False)
+        await report("resolving", repost=True)
+        semaphore = asyncio.Semaphore(VERIFY_CONCURRENCY)
+        results = dict({})  # member id -> line of the report
 
-                if not _:
-                    await channel.send(f"```md\n< {i+1:03d}/{len(members):03d} > {member.display_name}: {message}```")
-                continue
+        # 1. resolve
+        async def resolve(member):
+            async with semaphore:
+                try:
+                    resolved = await self._verify_resolve(guild, member)
+                except BaseException as e:
+                    resolved = {"member": member, "error": f"< error > while doing the verification: {hide_key(e)}"}
+            progress["resolved"] += 1
+            if "error" in resolved:
+                progress["errors"] += 1
+                results[member.id] = resolved["error"]
+            await report("resolving")
+            return resolved
+
+        resolved = await asyncio.gather(*[resolve(m) for m in members])
+
+        # 2. plan (sequential: the position roles are created once)
+        await report("planning")
+        plans = []
+        position_roles = dict({})
+        for r in [r for r in resolved if "error" not in r]:
+            try:
+                plans.append(await self._verify_plan(guild, config, role, r, position_roles))
+            except BaseException as e:
+                progress["errors"] += 1
+                results[r["member"].id] = f'< error > {hide_key(e)}'
 
-            elif role in member.roles:
-                pass
-            else:
-                if ctx:
-                    message, _ = await self._member(ctx, role, discordID=member.id, API_KEY=key)
-                else:
-                    message, _ = await self._member(member, role, discordID=member.id, API_KEY=key, context=False)
+        # 3. apply
+        semaphore = asyncio.Semaphore(VERIFY_APPLY_CONCURRENCY)
+
+        async def apply(plan):
+            async with semaphore:
+                try:
+                    results[plan["member"].id] = await self._verify_apply(plan)
+                except BaseException as e:
+                    progress["errors"] += 1
+                    results[plan["member"].id] = f'< error > {hide_key(e)}'
+            progress["applied"] += 1
+            await report("applying")
 
-                await channel.send(f"```md\n< {i+1:03d}/{len(members):03d} > {message}```")
+        await asyncio.gather(*[apply(plan) for plan in plans])
 
-        await channel.send(f"```md\n# done verifying```")
+        # final report
+        await report("done verifying")
+        lines = [f'{i+1:04d} {m.display_name} [{m.id}]: {results.get(m.id, "< error > not processed")}' for i, m in enumerate(members)]
+        file = File(io.BytesIO("\n".join(lines).encode()), filename=f'verify-{guild.id}-{ts_now()}.txt')
+        await channel.send(f"```md\n# done verifying\n< verified > {len(members) - progress['errors']}\n< errors > {progress['errors']}```", file=file)
 
     async def _loop_check(self, guild, channel, ctx=False, force=False):
 
@@ -550,7 +658,7 @@ class Verify(commands.Cog):
             return
 
         # get verified role
-        vrole = self.bot.get_module_role(guild.roles, config.get("roles_verified", {}))
+        vrole = self.bot.get_guild_module_role(guild, "verify", "roles_verified")
 
         # get unique faction_roles
         all_faction_roles = [id for faction_id, faction_roles_id in config.get("factions", {}).items() for id in faction_roles_id]
@@ -577,16 +685,7 @@ class Verify(commands.Cog):
                 await channel.send(f"```md\n< error >{msg}```")
                 continue
 
-            url = f'https://api.torn.com/faction/{faction_id}?selections=basic&key={key}'
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as r:
-                    try:
-                        req = await r.json()
-                    except BaseException:
-                        req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
-
-            if not isinstance(req, dict):
-                req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+            req = await self.bot.torn_api.get("faction", faction_id, "basic", key)
 
             # deal with api error
             if "error" in req:
@@ -660,7 +759,7 @@ class Verify(commands.Cog):
                 # update time
                 config["other"]["daily_verify"] = ts_now()
                 self.bot.configurations[guild.id]["verify"] = config
-                await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
+                self.bot.configurations.mark_dirty(guild.id, "verify")
 
                 # get full guild (async iterator doesn't return channels)
                 guild = self.bot.get_guild(guild.id)
@@ -710,7 +809,7 @@ class Verify(commands.Cog):
                 # update time
                 config["other"]["weekly_verify"] = ts_now()
                 self.bot.configurations[guild.id]["verify"] = config
-                await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
+                self.bot.configurations.mark_dirty(guild.id, "verify")
 
                 # get full guild (async iterator doesn't return channels)
                 guild = self.bot.get_guild(guild.id)
@@ -759,7 +858,7 @@ class Verify(commands.Cog):
                 # update time
                 config["other"]["daily_check"] = ts_now()
                 self.bot.configurations[guild.id]["verify"] = config
-                await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
+                self.bot.configurations.mark_dirty(guild.id, "verify")
 
                 # get full guild (async iterator doesn't return channels)
                 guild = self.bot.get_guild(guild.id)
@@ -808,7 +907,7 @@ class Verify(commands.Cog):
                 # update time
                 config["other"]["weekly_check"] = ts_now()
                 self.bot.configurations[guild.id]["verify"] = config
-                await set_configuration(self.bot.bot_id, guild.id, guild.name, self.bot.configurations[guild.id])
+                self.bot.configurations.mark_dirty(guild.id, "verify")
 
                 # get full guild (async iterator doesn't return channels)
                 guild = self.bot.get_guild(guild.id)
@@ -0,0 +1,60 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ in memory cache with a time to live per entry and LRU eviction
+    """
+
+    def __init__(self, ttl=600, size=10000):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.stats = dict({"hits": 0, "misses": 0})
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.stats["misses"] += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
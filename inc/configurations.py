@@ -0,0 +1,118 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import logging
+
+
+class ConfigurationStore(dict):
+    """ guild id -> configuration of the guild
+        Keeps indexes built when a guild configuration is set (!sync, guild join, tracker changes):
+        - module -> ids of the guilds with the module enabled
+        - (guild id, module, channels_*/roles_* key) -> discord ids as int
+
+        In place changes of a configuration that touch the modules, channels or roles need a reindex(guild_id)
+
+        Changes to persist are marked with mark_dirty(guild_id, module) and written in batches by the bot
+    """
+
+    def __init__(self, configurations=dict({})):
+        dict.__init__(self)
+        self.modules = dict({})  # module -> set of guild ids
+        self.ids = dict({})  # (guild id, module, key) -> tuple of int ids
+        self.id_sets = dict({})  # (guild id, module, key) -> frozenset of int ids
+        self.dirty = dict({})  # guild id -> set of modules to write (None for the whole configuration)
+        for guild_id, configuration in configurations.items():
+            self[guild_id] = configuration
+
+    def __setitem__(self, guild_id, configuration):
+        dict.__setitem__(self, guild_id, configuration)
+        self.reindex(guild_id)
+
+    def __delitem__(self, guild_id):
+        dict.__delitem__(self, guild_id)
+        self.unindex(guild_id)
+        self.dirty.pop(guild_id, None)
+
+    def pop(self, guild_id, *default):
+        configuration = dict.pop(self, guild_id, *default)
+        self.unindex(guild_id)
+        self.dirty.pop(guild_id, None)
+        return configuration
+
+    def mark_dirty(self, guild_id, module=None):
+        """ marks a module (or the whole configuration if None) to be written in the database
+            reindexes the guild configuration
+        """
+        self.reindex(guild_id)
+        if guild_id in self.dirty and self.dirty[guild_id] is None:
+            return
+        if module is None:
+            self.dirty[guild_id] = None
+        else:
+            self.dirty.setdefault(guild_id, set()).add(module)
+
+    def unindex(self, guild_id):
+        for guilds in self.modules.values():
+            guilds.discard(guild_id)
+        for k in [k for k in self.ids if k[0] == guild_id]:
+            del self.ids[k]
+            del self.id_sets[k]
+
+    def reindex(self, guild_id):
+        self.unindex(guild_id)
+        configuration = self.get(guild_id)
+        if not isinstance(configuration, dict):
+            return
+
+        for module, config in configuration.items():
+            if not config:
+                continue
+            self.modules.setdefault(module, set()).add(guild_id)
+
+            if not isinstance(config, dict):
+                continue
+            for key, values in config.items():
+                if key.startswith("channels_") or key.startswith("roles_"):
+                    ids = tuple([int(id) for id in values if str(id).isdigit()])
+                    self.ids[(guild_id, module, key)] = ids
+                    self.id_sets[(guild_id, module, key)] = frozenset(ids)
+
+        logging.debug(f'[configurations/reindex] guild {guild_id}: {len(configuration)} modules')
+
+    def guilds(self, module):
+        """ ids of the guilds with the module enabled
+        """
+        return self.modules.get(module, set())
+
+    def get_ids(self, guild_id, module, key):
+        """ channels or roles ids of a module key (ex: roles_alerts)
+        """
+        return self.ids.get((guild_id, module, key), tuple())
+
+    def has_id(self, guild_id, module, key, id):
+        return int(id) in self.id_sets.get((guild_id, module, key), frozenset())
+
+    def find_module(self, guild_id, config):
+        """ name of the module of a configuration given by the cogs
+        """
+        for module, c in self.get(guild_id, {}).items():
+            if c is config:
+                return module
+        return None
@@ -0,0 +1,114 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# import standard modules
+import asyncio
+import logging
+
+# import discord modules
+import discord
+
+# import bot functions and classes
+from inc.cache import TTLCache
+from inc.handy import hide_key
+
+
+class DMQueue:
+    """ outbound direct messages
+        - the lines pushed for a user are sent as one message when the queue is flushed
+        - rate limited sends (429) are retried after the delay given by discord
+        - the users who do not accept direct messages from the bot are skipped for a while
+        - the callback of a line is called once the line has been delivered (never if the send fails)
+    """
+
+    def __init__(self, concurrency=5, retries=3, blocked_ttl=6 * 3600):
+        self.retries = int(retries)
+        self.semaphore = asyncio.Semaphore(int(concurrency))
+        self.queue = dict({})  # user id -> (user, [(line, callback)])
+        self.blocked = TTLCache(ttl=blocked_ttl, size=20000)
+        self.stats = {"lines": 0, "messages": 0, "retries": 0, "blocked": 0, "failed": 0}
+
+    def is_blocked(self, user_id):
+        return self.blocked.get(user_id, False)
+
+    def push(self, user, line, callback=None):
+        """ queues a line for a user
+            - callback: function called without arguments when the line has been delivered
+            return False if the user does not accept direct messages
+        """
+        if self.is_blocked(user.id):
+            return False
+        self.queue.setdefault(user.id, (user, []))[1].append((line, callback))
+        self.stats["lines"] += 1
+        return True
+
+    async def flush(self):
+        """ sends one message per user with all the lines queued
+        """
+        queue = self.queue
+        self.queue = dict({})
+        await asyncio.gather(*[self.send(user, lines) for user, lines in queue.values()])
+
+    async def send(self, user, lines):
+        """ sends lines to a user in as few messages as possible
+            - lines: list of (line, callback)
+            return True if everything has been sent
+        """
+        # split on the discord message length (with the callbacks of the lines of each message)
+        messages = [("", [])]
+        for line, callback in lines:
+            if len(messages[-1][0]) + len(line) + 1 > 2000:
+                messages.append(("", []))
+            message, callbacks = messages[-1]
+            messages[-1] = (f'{message}\n{line}' if message else line[:2000], callbacks + [callback])
+
+        async with self.semaphore:
+            for message, callbacks in messages:
+                for retry in range(self.retries + 1):
+                    try:
+                        await user.send(message)
+                        self.stats["messages"] += 1
+                        break
+
+                    except discord.Forbidden:
+                        logging.info(f'[dm_queue/send] {user} does not accept direct messages')
+                        self.blocked.set(user.id, True)
+                        self.stats["blocked"] += 1
+                        return False
+
+                    except discord.HTTPException as e:
+                        if e.status != 429 or retry == self.retries:
+                            logging.warning(f'[dm_queue/send] {user}: {hide_key(e)}')
+                            self.stats["failed"] += 1
+                            return False
+                        try:
+                            delay = float(e.response.headers.get("Retry-After", 1))
+                        except BaseException:
+                            delay = 1
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(delay)
+
+                for callback in [c for c in callbacks if c is not None]:
+                    try:
+                        callback()
+                    except BaseException as e:
+                        logging.error(f'[dm_queue/send] {user} delivery callback: {hide_key(e)}')
+
+        return True
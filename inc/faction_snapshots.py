@@ -0,0 +1,134 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import asyncio
+import logging
+
+# import bot functions and classes
+from inc.handy import cleanhtml
+
+
+class FactionSnapshot:
+    """ parsed members table of a faction (from the basic selection)
+        - members: member id -> {id, name, state, description, details, last_action, last_action_ts, travel, destination}
+        - by_state: state -> member ids (most recent action first)
+        - by_destination: travel (Traveling, In, Returning) -> destination -> member ids
+    """
+
+    def __init__(self, payload, fetched):
+        self.id = payload.get("ID")
+        self.name = payload.get("name")
+        self.fetched = fetched
+        self.members = dict({})
+        self.by_state = dict({})
+        self.by_destination = {"Traveling": dict({}), "In": dict({}), "Returning": dict({})}
+
+        for k, v in payload.get("members", dict({})).items():
+            status = v.get("status", dict({}))
+            last_action = v.get("last_action", dict({}))
+            member = {
+                "id": k,
+                "name": v.get("name"),
+                "state": status.get("state"),
+                "description": status.get("description", ""),
+                "details": cleanhtml(status.get("details", "")),
+                "last_action": last_action.get("relative"),
+                "last_action_ts": int(last_action.get("timestamp", 0)),
+                "travel": None,
+                "destination": None}
+
+            if member["state"] in ["Traveling", "Abroad"]:
+                words = member["description"].split(" ")
+                member["travel"] = words[0]
+                member["destination"] = words[-1]
+                if member["travel"] in self.by_destination:
+                    self.by_destination[member["travel"]].setdefault(member["destination"], []).append(k)
+
+            self.members[k] = member
+            self.by_state.setdefault(member["state"], []).append(k)
+
+        for state, ids in self.by_state.items():
+            ids.sort(key=lambda id: -self.members[id]["last_action_ts"])
+
+    def state(self, state):
+        """ members in a state (most recent action first)
+        """
+        return [self.members[id] for id in self.by_state.get(state, [])]
+
+    def destination(self, travel, destination):
+        return [self.members[id] for id in self.by_destination.get(travel, dict({})).get(destination, [])]
+
+
+class FactionSnapshots:
+    """ recent snapshots of the factions shared by the commands
+        a faction is fetched at most once per cache window of the basic selection
+    """
+
+    def __init__(self, torn_api, size=500):
+        self.torn_api = torn_api
+        self.size = size
+        self.snapshots = dict({})  # faction id -> FactionSnapshot
+        self.key_factions = dict({})  # key -> (faction id of the key owner, time)
+
+    def ttl(self):
+        return self.torn_api.ttl(["basic"])
+
+    def fresh(self, snapshot):
+        return snapshot is not None and asyncio.get_event_loop().time() - snapshot.fetched < self.ttl()
+
+    def update(self, payload, key=None):
+        """ builds the snapshot of a faction from a payload with the basic selection
+            return the snapshot
+        """
+        snapshot = FactionSnapshot(payload, asyncio.get_event_loop().time())
+        if snapshot.id is None:
+            return snapshot
+
+        if len(self.snapshots) >= self.size:
+            for id in [id for id, s in self.snapshots.items() if not self.fresh(s)]:
+                del self.snapshots[id]
+            for id in list(self.snapshots)[:len(self.snapshots) - self.size + 1]:
+                del self.snapshots[id]
+
+        self.snapshots[str(snapshot.id)] = snapshot
+        if key is not None:
+            self.key_factions[key] = (str(snapshot.id), snapshot.fetched)
+        return snapshot
+
+    async def get(self, faction_id, key):
+        """ gets the snapshot of a faction (the faction of the key owner if no faction id)
+            return snapshot, None
+            return None, error: API error
+        """
+        if not faction_id:
+            faction_id, fetched = self.key_factions.get(key, (None, 0))
+            if asyncio.get_event_loop().time() - fetched > self.ttl():
+                faction_id = None
+
+        snapshot = self.snapshots.get(str(faction_id)) if faction_id else None
+        if self.fresh(snapshot):
+            return snapshot, None
+
+        req = await self.torn_api.get("faction", faction_id if faction_id else "", "basic", key)
+        if 'error' in req:
+            return None, req["error"]
+
+        logging.debug(f'[faction_snapshots/get] refresh faction {req.get("ID")}')
+        return self.update(req, key=None if faction_id else key), None
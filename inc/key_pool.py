@@ -0,0 +1,69 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import logging
+
+# import bot functions and classes
+from inc.yata_db import get_yata_users
+
+
+class MasterKeyPool:
+    """ master keys of the guilds (API keys of the server admins)
+        Keys are loaded once per guild from YATA's database and reloaded on !sync.
+        The health and budget of the keys come from the Torn API client.
+    """
+
+    def __init__(self, torn_api):
+        self.torn_api = torn_api
+        self.keys = dict({})  # guild id -> [(torn id, key), ...]
+        self.uses = dict({})  # key -> number of times picked
+
+    def loaded(self, guild_id):
+        return guild_id in self.keys
+
+    async def load(self, guild_id, torn_ids):
+        users = await get_yata_users(torn_ids) if len(torn_ids) else []
+        self.keys[guild_id] = [(user["tId"], user["value"]) for user in users]
+        logging.debug(f'[key_pool/load] guild {guild_id}: {len(self.keys[guild_id])} master keys')
+        return self.keys[guild_id]
+
+    def invalidate(self, guild_id):
+        self.keys.pop(guild_id, None)
+
+    def pick(self, guild_id):
+        """ picks the least loaded healthy key of the guild
+            falls back on the key that will be healthy first if they are all sidelined
+
+            return torn id, key
+            return None, None: no keys
+        """
+        keys = self.keys.get(guild_id, [])
+        if not len(keys):
+            return None, None
+
+        healthy = [(tornId, key) for tornId, key in keys if self.torn_api.key_healthy(key)]
+        if len(healthy):
+            tornId, key = sorted(healthy, key=lambda k: (-self.torn_api.key_budget(k[1]), self.uses.get(k[1], 0)))[0]
+        else:
+            tornId, key = sorted(keys, key=lambda k: self.torn_api.key_sidelined_until(k[1]))[0]
+            logging.warning(f'[key_pool/pick] guild {guild_id}: all master keys sidelined, using the first one back')
+
+        self.uses[key] = self.uses.get(key, 0) + 1
+        return tornId, key
@@ -0,0 +1,144 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# import standard modules
+import asyncio
+import logging
+
+# import discord modules
+import discord
+
+# import bot functions and classes
+from inc.handy import hide_key
+
+
+class LiveMessage:
+    """ one message per channel and topic, edited in place
+        - the edits of a channel are coalesced: at most one edit every `interval` seconds and only the last content is sent
+        - a new message is posted (and the previous one deleted) only when a ping is needed
+          or when the message is gone
+    """
+
+    def __init__(self, bot, interval=5):
+        self.bot = bot
+        self.interval = interval
+        self.messages = dict({})  # (channel id, topic) -> discord message
+        self.pending = dict({})  # (channel id, topic) -> (content, embed)
+        self.tasks = dict({})  # (channel id, topic) -> flush task
+        self.last_edit = dict({})  # channel id -> loop time of the last edit
+        self.locks = dict({})  # channel id -> lock serializing the edits of the channel topics
+        self.stats = {"posts": 0, "edits": 0, "coalesced": 0}
+
+    async def adopt(self, channel, topic, check, limit=10):
+        """ tracks the last message of the channel history matching check (after a restart)
+            return the message or None
+        """
+        key = (channel.id, topic)
+        if key not in self.messages:
+            try:
+                async for m in channel.history(limit=limit).filter(check):
+                    self.messages[key] = m
+                    break
+            except BaseException as e:
+                logging.warning(f'[live_message/adopt] {channel}: {hide_key(e)}')
+        return self.messages.get(key)
+
+    async def update(self, channel, topic, content=None, embed=None, repost=False):
+        """ sets the content of the live message of a topic
+            - repost: posts a new message (needed for a ping) and deletes the previous one
+            edits are delayed and coalesced, posts are sent at once
+            return the posted message or None for an edit
+        """
+        key = (channel.id, topic)
+        if repost or key not in self.messages:
+            self.pending.pop(key, None)
+            return await self._post(channel, key, content, embed)
+
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = (content, embed)
+        if key not in self.tasks or self.tasks[key].done():
+            self.tasks[key] = asyncio.get_event_loop().create_task(self._flush(channel, key))
+        return None
+
+    def tracked(self, channel_id, topic):
+        return (channel_id, topic) in self.messages
+
+    def forget(self, channel_id, topic):
+        """ stops tracking a topic (the message is left as it is)
+        """
+        key = (channel_id, topic)
+        self.messages.pop(key, None)
+        self.pending.pop(key, None)
+        task = self.tasks.pop(key, None)
+        if task is not None and not task.done():
+            task.cancel()
+
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = dict({})
+        self.pending = dict({})
+
+    async def _post(self, channel, key, content, embed):
+        previous = self.messages.pop(key, None)
+        message = await channel.send(content, embed=embed)
+        self.messages[key] = message
+        self.stats["posts"] += 1
+        if previous is not None:
+            try:
+                await previous.delete()
+            except discord.HTTPException as e:
+                logging.debug(f'[live_message/_post] {channel}: {e}')
+        return message
+
+    async def _flush(self, channel, key):
+        # the topics of a channel wait for the edit window in turn
+        async with self.locks.setdefault(channel.id, asyncio.Lock()):
+            loop = asyncio.get_event_loop()
+            wait = self.last_edit.get(channel.id, 0) + self.interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            if key not in self.pending:
+                return
+            self.last_edit[channel.id] = loop.time()
+            await self._edit(channel, key)
+
+    async def _edit(self, channel, key):
+        content, embed = self.pending.pop(key)
+        message = self.messages.get(key)
+        try:
+            if message is None:
+                await self._post(channel, key, content, embed)
+            else:
+                await message.edit(content=content, embed=embed)
+                self.stats["edits"] += 1
+        except asyncio.CancelledError:
+            raise
+        except discord.NotFound:
+            # the message has been deleted: post it again
+            self.messages.pop(key, None)
+            try:
+                await self._post(channel, key, content, embed)
+            except BaseException as e:
+                logging.warning(f'[live_message/_edit] {channel}: {hide_key(e)}')
+        except BaseException as e:
+            logging.warning(f'[live_message/_edit] {channel}: {hide_key(e)}')
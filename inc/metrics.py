@@ -0,0 +1,77 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import time
+
+# background tasks metrics: name -> TaskMetrics
+registry = dict({})
+
+
+class TaskMetrics:
+    """ durations of the ticks of a background task
+        a tick longer than the interval of the task is an overrun
+    """
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.ticks = 0
+        self.overruns = 0
+        self.jobs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.last = 0.0
+        self.total = 0.0
+        self.max = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def stop(self, jobs=0):
+        duration = time.monotonic() - self.started
+        self.ticks += 1
+        self.jobs += jobs
+        self.last = duration
+        self.total += duration
+        self.max = max(self.max, duration)
+        if duration > self.interval:
+            self.overruns += 1
+        return duration
+
+    def as_dict(self):
+        return dict({
+            "interval": self.interval,
+            "ticks": self.ticks,
+            "jobs": self.jobs,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "overruns": self.overruns,
+            "last": self.last,
+            "mean": self.total / self.ticks if self.ticks else 0.0,
+            "max": self.max})
+
+
+def get_task_metrics(name, interval=60):
+    """ gets (or creates) the metrics of a background task
+    """
+    if name not in registry:
+        registry[name] = TaskMetrics(name, interval)
+    return registry[name]
@@ -0,0 +1,417 @@
+"""
+Copyright 2020 kivou.2000607@gmail.com
+
+This file is part of yata-bot.
+
+    yata is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    any later version.
+
+    yata is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with yata-bot. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# import standard modules
+import asyncio
+import aiohttp
+import logging
+
+# import bot functions and classes
+from inc.handy import *
+
+
+# seconds a response is kept in cache, by selection (the shortest ttl of the selections is used)
+# Torn caches its responses for about 30 seconds so there is no point in asking again before that
+CACHE_TTL = {"default": 30, "discord": 300}
+
+# selections that return the same payload whatever the key used
+# (only when an id is given, otherwise the payload depends on the key owner)
+PUBLIC_SELECTIONS = {
+    "user": ["basic", "profile", "personalstats", "discord", "timestamp"],
+    "faction": ["basic", "chain", "timestamp"],
+    "torn": ["rackets", "territory", "timestamp"]}
+
+# seconds a key is sidelined after an API error, by error code
+# 2: incorrect key, 5: too many requests, 10: key owner in federal jail, 13: key disabled (owner inactivity)
+KEY_COOLDOWN = {2: 3600, 5: 60, 10: 3600, 13: 3600}
+
+
+class TokenBucket:
+    """ token bucket of an API key
+        rate: tokens refilled per second
+        capacity: maximum number of tokens (burst)
+
+        Callers are queued in order on a lock and wait for a token instead of sending too many requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = asyncio.get_event_loop().time()
+        self.lock = asyncio.Lock()
+
+        # metrics
+        self.queued = 0
+        self.max_queued = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def refill(self):
+        now = asyncio.get_event_loop().time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self.refill()
+        return max(0, int(self.tokens))
+
+    def pause(self, seconds):
+        """ empties the bucket for a number of seconds (after a rate limit error)
+        """
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    async def acquire(self):
+        start = asyncio.get_event_loop().time()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            async with self.lock:
+                self.refill()
+                while self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    self.refill()
+                self.tokens -= 1
+        finally:
+            self.queued -= 1
+
+        wait = asyncio.get_event_loop().time() - start
+        self.acquired += 1
+        if wait > 0.001:
+            self.waited += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+
+class TornAPI:
+    """ Torn API client shared by all the cogs
+        One aiohttp session (keep-alive connection pool) for the bot lifetime
+        Responses are cached by selections: a call is answered by any fresh payload containing its selections
+        Concurrent calls share the same request, and can add their selections to a request waiting for its token
+        Requests are rate limited per key (see TokenBucket)
+    """
+
+    url = "https://api.torn.com"
+
+    def __init__(self, limit=100, limit_per_host=30, keepalive_timeout=60, timeout=15, cache_ttl=None, cache_size=5000, rate_limit=90, rate_burst=10):
+        self.limit = int(limit)
+        self.limit_per_host = int(limit_per_host)
+        self.keepalive_timeout = int(keepalive_timeout)
+        self.timeout = int(timeout)
+        self.session = None
+
+        # response cache
+        self.cache_ttl = dict(CACHE_TTL)
+        self.cache_ttl.update({} if cache_ttl is None else cache_ttl)
+        self.cache_size = int(cache_size)
+        self.cache = dict({})  # cache key -> [(expires, selections, payload), ...]
+        self.pending = dict({})  # cache key -> [{"selections", "future", "sent", "merge", "key"}, ...] requests in flight
+        self.stats = {"calls": 0, "requests": 0, "cache_hits": 0, "subset_hits": 0, "shared": 0, "merged": 0, "unmerged": 0, "rate_limited": 0}
+
+        # rate limiter: Torn allows 100 requests per minute per key
+        # over any 60s window a bucket sends at most rate_burst + rate_limit requests
+        self.rate_limit = int(rate_limit)
+        self.rate_burst = int(rate_burst)
+        self.buckets = dict({})  # key -> TokenBucket
+
+        # health of the keys: key -> {"errors": [(time, code), ...], "until": time}
+        self.health = dict({})
+
+    async def open(self):
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        logging.info(f'[torn_api/open] session opened (limit {self.limit}, per host {self.limit_per_host}, timeout {self.timeout}s)')
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logging.info('[torn_api/close] session closed')
+        self.session = None
+
+    def build_url(self, section, id="", selections=[], **params):
+        selections = selections.split(",") if isinstance(selections, str) else selections
+        id = "" if id is None else id
+        query = [f'selections={",".join([s for s in selections if s])}']
+        query += [f'{k}={v}' for k, v in params.items() if v is not None]
+        return f'{self.url}/{section}/{id}?{"&".join(query)}'
+
+    def bucket(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.rate_limit / 60.0, self.rate_burst)
+        return self.buckets[key]
+
+    def key_budget(self, key):
+        """ number of requests the key can send right away
+        """
+        return self.buckets[key].available() if key in self.buckets else self.rate_burst
+
+    def key_healthy(self, key):
+        """ False if the key has been sidelined after an error
+        """
+        health = self.health.get(key)
+        return health is None or health["until"] < asyncio.get_event_loop().time()
+
+    def key_sidelined_until(self, key):
+        health = self.health.get(key)
+        return 0 if health is None else health["until"]
+
+    def key_errors(self, key):
+        """ list of the recent (time, error code) of the key
+        """
+        return list(self.health.get(key, {}).get("errors", []))
+
+    def report_error(self, key, code):
+        now = asyncio.get_event_loop().time()
+        health = self.health.setdefault(key, {"errors": [], "until": 0})
+        health["errors"] = health["errors"][-9:] + [(now, code)]
+        if code in KEY_COOLDOWN:
+            health["until"] = max(health["until"], now + KEY_COOLDOWN[code])
+            logging.info(f'[torn_api/report_error] key sidelined for {KEY_COOLDOWN[code]}s after error code {code}')
+
+    def metrics(self):
+        """ returns the client metrics: calls, cache, and the rate limiter queues and waits
+        """
+        buckets = list(self.buckets.values())
+        acquired = sum([b.acquired for b in buckets])
+        waited = sum([b.waited for b in buckets])
+        wait_time = sum([b.wait_time for b in buckets])
+        metrics = dict(self.stats)
+        metrics.update({
+            "cache_size": sum([len(v) for v in self.cache.values()]),
+            "in_flight": sum([len(v) for v in self.pending.values()]),
+            "keys": len(buckets),
+            "queue_depth": sum([b.queued for b in buckets]),
+            "max_queue_depth": max([b.max_queued for b in buckets] + [0]),
+            "requests_delayed": waited,
+            "mean_wait": wait_time / waited if waited else 0.0,
+            "max_wait": max([b.max_wait_time for b in buckets] + [0.0]),
+            "delayed_ratio": waited / acquired if acquired else 0.0,
+            "keys_sidelined": len([k for k in self.health if not self.key_healthy(k)])})
+        return metrics
+
+    def ttl(self, selections):
+        return min([self.cache_ttl.get(s, self.cache_ttl["default"]) for s in selections] + [self.cache_ttl["default"]])
+
+    def cache_key(self, section, id, selections, key, params):
+        """ cache group of a call: payloads of the same group only differ by their selections
+        """
+        id = "" if id is None else str(id)
+        public = PUBLIC_SELECTIONS.get(section, [])
+        if section == "torn" or (id and all([s in public for s in selections])):
+            scope = None
+        else:
+            scope = key
+        return (section, id, scope, tuple(sorted(params.items())))
+
+    def cache_get(self, cache_key, selections):
+        """ returns a fresh payload of the group containing all the selections
+            calls without selections only match payloads without selections
+        """
+        now = asyncio.get_event_loop().time()
+        entries = [e for e in self.cache.get(cache_key, []) if e[0] > now]
+        if not len(entries):
+            self.cache.pop(cache_key, None)
+            return None
+
+        self.cache[cache_key] = entries
+        for expires, cached, payload in entries:
+            if selections == cached or (len(selections) and selections <= cached):
+                if selections != cached:
+                    self.stats["subset_hits"] += 1
+                return payload
+
+        return None
+
+    def cache_set(self, cache_key, selections, payload, ttl):
+        now = asyncio.get_event_loop().time()
+        expires = now + ttl
+
+        # drop expired entries and the ones covered by the new payload
+        entries = [e for e in self.cache.pop(cache_key, []) if e[0] > now and not (e[1] <= selections and e[0] <= expires)]
+        if len(self.cache) >= self.cache_size:
+            # remove expired groups then the oldest ones
+            self.cache = {k: v for k, v in self.cache.items() if max([e[0] for e in v]) > now}
+            for k in list(self.cache)[:len(self.cache) - self.cache_size + 1]:
+                del self.cache[k]
+        self.cache[cache_key] = entries + [(expires, selections, payload)]
+
+    def pending_get(self, cache_key, selections):
+        """ returns the request in flight answering the selections
+            widens a request still waiting for its token if needed
+        """
+        entries = self.pending.get(cache_key, [])
+        for entry in entries:
+            if selections == entry["selections"] or (len(selections) and selections <= entry["selections"]):
+                return entry
+
+        if len(selections):
+            for entry in entries:
+                if entry["merge"] and not entry["sent"]:
+                    entry["selections"] = entry["selections"] | selections
+                    self.stats["merged"] += 1
+                    return entry
+
+        return None
+
+    async def get(self, section, id="", selections=[], key="", timeout=None, cache=True, merge=True, **params):
+        """ makes a Torn API call
+            - section: user, faction, torn, ...
+            - id: torn id (or discord id for discord selection), empty for the key owner
+            - selections: list of selections or comma separated string
+            - key: API key
+            - cache: False to force a new request
+            - merge: False to prevent the call from being merged with other selections
+
+            The payload is shared with the other callers: it should not be modified.
+            It can contain more selections than asked for (served from a wider call).
+
+            return the json payload as a dict
+            return {"error": {"code": -1, "error": ...}} if the payload can't be read
+        """
+        self.stats["calls"] += 1
+        selections = [s for s in (selections.split(",") if isinstance(selections, str) else selections) if s]
+        wanted = frozenset(selections)
+        cache_key = self.cache_key(section, id, selections, key, params)
+        ttl = self.ttl(selections)
+
+        # fresh response in cache
+        if cache and ttl > 0:
+            payload = self.cache_get(cache_key, wanted)
+            if payload is not None:
+                self.stats["cache_hits"] += 1
+                return payload
+
+        # same or wider request already in flight (or still waiting to be sent)
+        entry = self.pending_get(cache_key, wanted) if cache and merge else None
+        if entry is not None:
+            self.stats["shared"] += 1
+            try:
+                req = await asyncio.shield(entry["future"])
+            except asyncio.CancelledError:
+                # only make the request again if the caller that sent it has been cancelled
+                if not entry["future"].cancelled():
+                    raise
+            else:
+                return await self.unmerge(req, entry, wanted, section, id, selections, key, timeout, params)
+
+        future = asyncio.get_event_loop().create_future()
+        entry = {"selections": wanted, "future": future, "sent": False, "merge": merge and len(wanted) > 0, "key": key}
+        self.pending.setdefault(cache_key, []).append(entry)
+        try:
+            # the selections of the request can be widened until it gets its token
+            await self.bucket(key).acquire()
+            entry["sent"] = True
+            sent = sorted(entry["selections"])
+            req = await self.request(section, id=id, selections=sent, key=key, timeout=timeout, acquired=True, **params)
+            ttl = self.ttl(sent)
+            if ttl > 0 and "error" not in req:
+                self.cache_set(cache_key, entry["selections"], req, ttl)
+            future.set_result(req)
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except BaseException as e:
+            future.set_exception(e)
+            # the exception is also raised here, avoid never retrieved warnings
+            future.exception()
+            raise
+
+        finally:
+            entries = self.pending.get(cache_key, [])
+            if entry in entries:
+                entries.remove(entry)
+            if not len(entries):
+                self.pending.pop(cache_key, None)
+
+        return await self.unmerge(req, entry, wanted, section, id, selections, key, timeout, params)
+
+    async def unmerge(self, req, entry, wanted, section, id, selections, key, timeout, params):
+        """ a call merged into a wider request that failed is sent again on its own
+            (the error can come from a selection it didn't ask for)
+            key errors are returned as is to the caller of the same key
+            and sent again with its own key for a caller sharing the request of another key (public selections)
+        """
+        code = req.get("error", {}).get("code") if "error" in req else None
+        if code is None:
+            return req
+
+        if code in KEY_COOLDOWN:
+            if entry["key"] == key:
+                return req
+            logging.debug(f'[torn_api/unmerge] {section} {",".join(selections)}: retry with own key after key error {code}')
+            self.stats["unmerged"] += 1
+            return await self.get(section, id=id, selections=selections, key=key, timeout=timeout, merge=False, **params)
+
+        if entry["selections"] == wanted:
+            return req
+
+        logging.debug(f'[torn_api/unmerge] {section} {",".join(selections)}: retry alone after error {code}')
+        self.stats["unmerged"] += 1
+        return await self.get(section, id=id, selections=selections, key=key, timeout=timeout, merge=False, **params)
+
+    async def request(self, section, id="", selections=[], key="", timeout=None, acquired=False, **params):
+        """ sends the request to the Torn API (no cache)
+            waits for a token of the key before sending (unless already acquired)
+        """
+        if self.session is None or self.session.closed:
+            await self.open()
+
+        bucket = self.bucket(key)
+        if not acquired:
+            await bucket.acquire()
+        self.stats["requests"] += 1
+
+        url = self.build_url(section, id=id, selections=selections, **params)
+        try:
+            kwargs = {} if timeout is None else {"timeout": aiohttp.ClientTimeout(total=timeout)}
+            async with self.session.get(f'{url}&key={key}', **kwargs) as r:
+                req = await r.json(content_type=None)
+
+        except asyncio.CancelledError:
+            raise
+
+        except asyncio.TimeoutError:
+            logging.warning(f'[torn_api/get] timeout on {url}')
+            req = {'error': {'error': 'API is not responding... #blameched', 'code': -1}}
+
+        except BaseException as e:
+            logging.warning(f'[torn_api/get] {url}: {hide_key(e)}')
+            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+
+        if not isinstance(req, dict):
+            req = {'error': {'error': 'API is talking shit... #blameched', 'code': -1}}
+
+        # too many requests: hold the key for the rest of the minute
+        if req.get("error", {}).get("code") == 5:
+            logging.warning(f'[torn_api/get] rate limited on {url}')
+            self.stats["rate_limited"] += 1
+            bucket.pause(30)
+
+        if "error" in req:
+            self.report_error(key, req["error"].get("code"))
+
+        return req
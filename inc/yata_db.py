@@ -20,7 +20,6 @@ This file is part of yata-bot.
 # import standard modules
 import json
 import asyncio
-import aiohttp
 import re
 import os
 import asyncpg
@@ -44,88 +43,117 @@ from datetime import datetime
 #     JOIN player_player ON player_key.player_id = player_player.id;
 
 
-def load_configurations(bot_id):
+# connection pool shared by all the async helpers
+# asyncpg prepares and caches the parameterized statements on each connection of the pool
+pool = None
+
+
+async def init_pool(min_size=1, max_size=10):
+    """ creates the bot lifetime connection pool
+        does nothing if the pool already exists
+    """
+    global pool
+    if pool is not None:
+        return pool
+
     db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    con = psycopg2.connect(**db_cred)
+    dbname = db_cred["dbname"]
+    del db_cred["dbname"]
+    pool = await asyncpg.create_pool(database=dbname, min_size=int(min_size), max_size=int(max_size), **db_cred)
+    logging.info(f'[yata_db/init_pool] pool created (min {min_size}, max {max_size})')
+    return pool
 
-    # get bot
-    cur = con.cursor()
-    cur.execute(f"SELECT token, name FROM bot_bot WHERE id = {bot_id};")
-    token, name = cur.fetchone()
-    cur.close()
 
-    # get servers configuration linked with the bot
-    cur = con.cursor()
-    cur.execute(f"SELECT id, discord_id, name, configuration FROM bot_server WHERE bot_server.bot_id = {bot_id};")
-    configurations_raw = cur.fetchall()
-    cur.close()
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        logging.info('[yata_db/close_pool] pool closed')
+    pool = None
+
+
+def get_pool():
+    if pool is None:
+        raise RuntimeError("yata_db pool not initialized: call init_pool first")
+    return pool
+
+
+async def load_configurations(bot_id):
+    """ gets the bot token and the configurations of its servers
+        both queries run concurrently on the pool
+        return token, {discord_id: configuration}
+    """
+    bot, servers = await asyncio.gather(
+        get_pool().fetchrow('SELECT token, name FROM bot_bot WHERE id = $1', int(bot_id)),
+        get_pool().fetch('SELECT discord_id, configuration FROM bot_server WHERE bot_id = $1', int(bot_id)))
 
     # format configrations to a dict
     configurations = dict({})
-    for id, discord_id, name, configuration in configurations_raw:
-        configurations[discord_id] = json.loads(configuration)
+    for server in servers:
+        configurations[server.get("discord_id")] = json.loads(server.get("configuration"))
 
-    con.close()
-    return token, configurations
+    return bot.get("token"), configurations
 
 
 async def get_configuration(bot_id, discord_id):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
-    server = await con.fetchrow(f'SELECT configuration FROM bot_server WHERE bot_id = {bot_id} AND discord_id = {discord_id};')
+    server = await get_pool().fetchrow('SELECT configuration FROM bot_server WHERE bot_id = $1 AND discord_id = $2', int(bot_id), int(discord_id))
     return False if server is None else json.loads(server.get("configuration"))
 
 
 async def set_n_servers(bot_id, n):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
-
-    await con.execute('''
-        UPDATE bot_bot SET number_of_servers = $2 WHERE id = $1
-        ''', bot_id, n)
-    await con.close()
+    await get_pool().execute('UPDATE bot_bot SET number_of_servers = $2 WHERE id = $1', int(bot_id), n)
 
 
 async def set_configuration(bot_id, discord_id, server_name, configuration):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
-
-    # check if server already in the database
-    server = await con.fetchrow(f'SELECT * FROM bot_server WHERE bot_id = {bot_id} AND discord_id = {discord_id};')
-    if server is None:  # create if not in the db
-        # logging.debug(f"[yata_db/set_configuration] Create db configuration {server_name}: {configuration}")
-        await con.execute('''
-        INSERT INTO bot_server(bot_id, discord_id, name, configuration, secret) VALUES($1, $2, $3, $4, $5)
-        ''', bot_id, discord_id, server_name, json.dumps(configuration), 'x')
-    else:  # update otherwise
-        # logging.debug(f"[yata_db/set_configuration] Update db configuration {server_name}: {configuration}")
-        await con.execute('''
+    async with get_pool().acquire() as con:
+        # update if server already in the database
+        status = await con.execute('''
         UPDATE bot_server SET name = $3, configuration = $4 WHERE bot_id = $1 AND discord_id = $2
-        ''', bot_id, discord_id, server_name, json.dumps(configuration))
-    await con.close()
+        ''', int(bot_id), int(discord_id), server_name, json.dumps(configuration))
+
+        # create if not in the db
+        if status == "UPDATE 0":
+            # logging.debug(f"[yata_db/set_configuration] Create db configuration {server_name}: {configuration}")
+            await con.execute('''
+            INSERT INTO bot_server(bot_id, discord_id, name, configuration, secret) VALUES($1, $2, $3, $4, $5)
+            ''', int(bot_id), int(discord_id), server_name, json.dumps(configuration), 'x')
+
+
+async def update_configuration(bot_id, discord_id, server_name, modules, deleted, configuration):
+    """ partial update of a server configuration
+        - modules: {module: configuration} sub documents to replace
+        - deleted: list of the modules to remove
+        - configuration: full configuration, only used if the server is not in the database yet
+
+        one atomic upsert: the path of each module is set in the configuration in the database
+        (the result is converted back to the type of the column on assignment)
+    """
+    args = [int(bot_id), int(discord_id), server_name, json.dumps(configuration), list(deleted)]
+    merged = 'bot_server.configuration::jsonb - $5::text[]'
+    for module, sub in modules.items():
+        args += [[module], json.dumps(sub)]
+        merged = f'jsonb_set({merged}, ${len(args) - 1}::text[], ${len(args)}::jsonb)'
+
+    await get_pool().execute(f'''
+    INSERT INTO bot_server(bot_id, discord_id, name, configuration, secret) VALUES($1, $2, $3, $4, 'x')
+    ON CONFLICT (bot_id, discord_id) DO UPDATE SET name = EXCLUDED.name, configuration = {merged}
+    ''', *args)
 
 
 async def get_server_admins(bot_id, discord_id):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
-    server = await con.fetchrow(f'SELECT * FROM bot_server WHERE bot_id = {bot_id} AND discord_id = {discord_id};')
-    if server is None:
-        return {}, 'x'
+    async with get_pool().acquire() as con:
+        server = await con.fetchrow('SELECT id, configuration FROM bot_server WHERE bot_id = $1 AND discord_id = $2', int(bot_id), int(discord_id))
+        if server is None:
+            return {}, 'x'
 
-    server_yata_id = server.get("id")
-    players_yata_id = await con.fetch(f'SELECT player_id FROM bot_server_server_admin WHERE server_id = {server_yata_id};')
+        players = await con.fetch('''
+        SELECT player_player."tId", player_player."dId", player_player."name" FROM bot_server_server_admin
+        JOIN player_player ON player_player.id = bot_server_server_admin.player_id
+        WHERE bot_server_server_admin.server_id = $1
+        ''', server.get("id"))
 
     admins = {}
-    for player_yata_id in [player.get("player_id") for player in players_yata_id]:
-        player = await con.fetchrow(f'SELECT "tId", "dId", "name" FROM player_player WHERE "id" = {player_yata_id};')
+    for player in players:
         dId = player.get("dId", 0)
         if dId:
             admins[str(dId)] = {"name": player.get("name", "?"), "torn_id": player.get("tId")}
@@ -139,24 +167,27 @@ async def get_server_admins(bot_id, discord_id):
 
 async def get_yata_user(user_id, type="T"):
     # get YATA user
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
     if type == "T":
-        user = await con.fetch(f'SELECT "tId", "name", "value" FROM player_view_player_key WHERE "tId" = {user_id};')
+        user = await get_pool().fetch('SELECT "tId", "name", "value" FROM player_view_player_key WHERE "tId" = $1', int(user_id))
     elif type == "D":
-        user = await con.fetch(f'SELECT "tId", "name", "value" FROM player_view_player_key WHERE "dId" = {user_id};')
-    await con.close()
+        user = await get_pool().fetch('SELECT "tId", "name", "value" FROM player_view_player_key WHERE "dId" = $1', int(user_id))
 
     return user
 
 
+async def get_yata_users(torn_ids, botPerm=False):
+    # get YATA users from a list of torn ids (only the ones who gave their permission to the bot if botPerm)
+    if botPerm:
+        return await get_pool().fetch('SELECT "tId", "name", "value" FROM player_view_player_key WHERE "tId" = ANY($1::int[]) AND "botPerm"', [int(i) for i in torn_ids])
+    else:
+        return await get_pool().fetch('SELECT "tId", "name", "value" FROM player_view_player_key WHERE "tId" = ANY($1::int[])', [int(i) for i in torn_ids])
+
+
 def get_secret(name):
     db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
     con = psycopg2.connect(**db_cred)
     cur = con.cursor()
-    cur.execute(f"SELECT uid, secret, hookurl FROM bot_chat WHERE name = '{name}';")
+    cur.execute("SELECT uid, secret, hookurl FROM bot_chat WHERE name = %s;", (name,))
     uid, secret, hookurl = cur.fetchone()
     cur.close()
     con.close()
@@ -164,51 +195,96 @@ def get_secret(name):
 
 
 async def push_data(bot_id, timestamp, data, module):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
     if module == "rackets":
-        await con.execute('UPDATE bot_rackets SET timestamp = $1, rackets = $2 WHERE id = $3', timestamp, json.dumps(data), bot_id)
+        await get_pool().execute('UPDATE bot_rackets SET timestamp = $1, rackets = $2 WHERE id = $3', timestamp, json.dumps(data), int(bot_id))
     elif module == "stocks":
-        await con.execute('UPDATE bot_stocks SET timestamp = $1, rackets = $2 WHERE id = $3', timestamp, json.dumps(data), bot_id)
-    await con.close()
+        await get_pool().execute('UPDATE bot_stocks SET timestamp = $1, rackets = $2 WHERE id = $3', timestamp, json.dumps(data), int(bot_id))
 
 
-def get_data(bot_id, module):
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    con = psycopg2.connect(**db_cred)
-    cur = con.cursor()
+async def get_data(bot_id, module):
     if module == "rackets":
-        cur.execute(f"SELECT timestamp, rackets FROM bot_rackets WHERE id = {bot_id};")
+        row = await get_pool().fetchrow('SELECT timestamp, rackets FROM bot_rackets WHERE id = $1', int(bot_id))
     elif module == "stocks":
-        cur.execute(f"SELECT timestamp, rackets FROM bot_stocks WHERE id = {bot_id};")
+        row = await get_pool().fetchrow('SELECT timestamp, rackets FROM bot_stocks WHERE id = $1', int(bot_id))
 
-    timestamp, data = cur.fetchone()
-    cur.close()
-    con.close()
-    return timestamp, json.loads(data)
+    return row.get("timestamp"), json.loads(row.get("rackets"))
 
 
 async def get_faction_name(tId):
     if str(tId).isdigit():
         tId = int(tId)
-        db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-        dbname = db_cred["dbname"]
-        del db_cred["dbname"]
-        con = await asyncpg.connect(database=dbname, **db_cred)
-        row = await con.fetchrow('SELECT name FROM faction_faction WHERE "tId" = $1', tId)
-        await con.close()
+        row = await get_pool().fetchrow('SELECT name FROM faction_faction WHERE "tId" = $1', tId)
         return f'Faction [{tId}]' if row is None else f'{html.unescape(row.get("name", "Faction"))} [{tId}]'
     else:
         return f'Faction [{tId}]'
 
 
+async def update_notifications(states, deleted=[]):
+    """ batch update of the notifications states: [(torn id, state), ...]
+        only the keys still in the database are merged (a notification turned off on YATA in the meantime stays off)
+        - deleted: keys to remove
+    """
+    await get_pool().executemany('''
+    UPDATE player_player SET "notifications" = ((
+        "notifications"::jsonb || (SELECT coalesce(jsonb_object_agg(k, v), '{}'::jsonb) FROM jsonb_each($2::jsonb) AS state(k, v) WHERE "notifications"::jsonb ? k)
+    ) - $3::text[])::text WHERE "tId" = $1
+    ''', [(int(tId), state, list(deleted)) for tId, state in states])
+
+
 async def reset_notifications(tornId):
-    # get YATA user
-    db_cred = json.loads(os.environ.get("DB_CREDENTIALS"))
-    dbname = db_cred["dbname"]
-    del db_cred["dbname"]
-    con = await asyncpg.connect(database=dbname, **db_cred)
-    await con.execute('UPDATE player_player SET "activateNotifications"=$1, "notifications"=$2 WHERE "tId"=$3', False, json.dumps({}), tornId)
-    await con.close()
+    await get_pool().execute('UPDATE player_player SET "activateNotifications"=$1, "notifications"=$2 WHERE "tId"=$3', False, json.dumps({}), int(tornId))
+
+
+async def init_notifier_leases(partitions):
+    """ adds the missing leases of the notifier partitions (one row per partition)
+        the tables are not created by the bot (see sql/notifier_leases.sql)
+    """
+    await get_pool().execute('''
+    INSERT INTO bot_notifier_lease(part) SELECT generate_series(0, $1 - 1) ON CONFLICT DO NOTHING
+    ''', int(partitions))
+
+
+async def lease_notifier_partitions(owner, partitions, ttl):
+    """ heartbeat of a notifier process
+        - renews the leases of the owner and computes its fair share: ceil(partitions / live processes)
+        - releases the leases over the share and claims free or expired ones (FOR UPDATE SKIP LOCKED) up to the share
+        a lease not renewed within ttl seconds (process crashed or hung) can be claimed by the other processes
+        return number of live processes, set of the partitions leased
+    """
+    ttl = float(ttl)
+    async with get_pool().acquire() as con, con.transaction():
+        await con.execute('''
+        INSERT INTO bot_notifier_worker(owner, expires_at) VALUES($1, now() + make_interval(secs => $2))
+        ON CONFLICT (owner) DO UPDATE SET expires_at = EXCLUDED.expires_at
+        ''', owner, ttl)
+        await con.execute('DELETE FROM bot_notifier_worker WHERE expires_at < now()')
+        workers = await con.fetchval('SELECT count(*) FROM bot_notifier_worker')
+        share = -(-int(partitions) // max(1, workers))
+
+        renewed = await con.fetch('''
+        UPDATE bot_notifier_lease SET expires_at = now() + make_interval(secs => $2)
+        WHERE owner = $1 AND expires_at > now() AND part < $3 RETURNING part
+        ''', owner, ttl, int(partitions))
+        leased = sorted([r.get("part") for r in renewed])
+
+        if len(leased) > share:
+            await con.execute('UPDATE bot_notifier_lease SET owner = NULL WHERE owner = $1 AND part = ANY($2::int[])', owner, leased[share:])
+            leased = leased[:share]
+
+        elif len(leased) < share:
+            claimed = await con.fetch('''
+            WITH free AS (
+                SELECT part FROM bot_notifier_lease WHERE part < $3 AND (owner IS NULL OR expires_at < now())
+                ORDER BY part LIMIT $4 FOR UPDATE SKIP LOCKED)
+            UPDATE bot_notifier_lease SET owner = $1, expires_at = now() + make_interval(secs => $2)
+            FROM free WHERE bot_notifier_lease.part = free.part RETURNING bot_notifier_lease.part
+            ''', owner, ttl, int(partitions), share - len(leased))
+            leased += [r.get("part") for r in claimed]
+
+    return workers, set(leased)
+
+
+async def release_notifier_partitions(owner):
+    async with get_pool().acquire() as con, con.transaction():
+        await con.execute('UPDATE bot_notifier_lease SET owner = NULL WHERE owner = $1', owner)
+        await con.execute('DELETE FROM bot_notifier_worker WHERE owner = $1', owner)
@@ -0,0 +1,16 @@
+-- leases of the personal notifications partitions shared by the notifier processes (YATA_NOTIFY_WORKER)
+-- to be applied once to the YATA database before starting more than one notifier process
+-- the bot only reads and writes these tables (the partitions rows are added on startup if missing)
+
+-- one row per partition (torn id % NOTIFY_PARTITIONS): process serving it until expires_at
+CREATE TABLE IF NOT EXISTS bot_notifier_lease (
+    part integer PRIMARY KEY,
+    owner text,
+    expires_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- heartbeat of each notifier process (hostname-pid): live processes share the partitions
+CREATE TABLE IF NOT EXISTS bot_notifier_worker (
+    owner text PRIMARY KEY,
+    expires_at timestamptz NOT NULL
+);
@@ -20,30 +20,22 @@ This file is part of yata-bot.
 # import standard modules
 import os
 import json
-import psycopg2
 import logging
 import logging.config
 import time
 import sys
+import signal
+import asyncio
+import importlib
+
+started = time.monotonic()
 
 # import bot
 from bots.yata import YataBot
-
-# import cogs
-from cogs.verify import Verify
-from cogs.loot import Loot
-from cogs.stocks import Stocks
-from cogs.api import API
-from cogs.chain import Chain
-from cogs.racket import Racket
-from cogs.admin import Admin
-from cogs.revive import Revive
-from cogs.misc import Misc
-from cogs.crimes import Crimes
-from cogs.repository import Repository
-from cogs.marvin import Marvin
+from inc.torn_api import TornAPI
 
 # import includes
+from inc.yata_db import init_pool
 from inc.yata_db import load_configurations
 
 # logging
@@ -54,14 +46,60 @@ logging.info("info")
 logging.warning("warning")
 logging.error("error")
 
+# cogs: name -> (module, class)
+# modules are only imported if the cog is loaded by the bot
+COGS = {
+    "admin": ("cogs.admin", "Admin"),
+    "verify": ("cogs.verify", "Verify"),
+    "loot": ("cogs.loot", "Loot"),
+    "stocks": ("cogs.stocks", "Stocks"),
+    "racket": ("cogs.racket", "Racket"),
+    "revive": ("cogs.revive", "Revive"),
+    "crimes": ("cogs.crimes", "Crimes"),
+    "api": ("cogs.api", "API"),
+    "chain": ("cogs.chain", "Chain"),
+    "misc": ("cogs.misc", "Misc"),
+    "repository": ("cogs.repository", "Repository"),
+    "marvin": ("cogs.marvin", "Marvin")}
+
+# cogs loaded by bot id (admin is loaded by all bots)
+BOT_COGS = {
+    1: ["verify", "loot", "stocks", "racket", "revive", "crimes", "api", "chain", "misc", "repository"],
+    2: ["marvin"],
+    3: ["verify", "loot", "stocks", "racket", "revive", "crimes", "api", "chain", "misc", "repository"],
+    4: ["stocks"]}
+
 # get basic config
 bot_id = os.environ.get("YATA_ID", 1)
+
+# notifier worker: extra process of the bot 3 that only serves its share of the personal notifications
+notify_worker = bool(int(os.environ.get("YATA_NOTIFY_WORKER", 0)))
+if notify_worker and int(bot_id) != 3:
+    logging.error(f'YATA_NOTIFY_WORKER is only supported by the bot 3 (the notifier), not by bot id = {bot_id}')
+    sys.exit(1)
 github_token = os.environ.get("GITHUB_TOKEN", "")
 main_server_id = os.environ.get("MAIN_SERVER_ID", 581227228537421825)
 logging.info(f'Starting bot: bot id = {bot_id}')
 
-# get configurations from YATA's database
-token, configurations = load_configurations(bot_id)
+# torn api client configuration
+torn_api = TornAPI(limit=os.environ.get("TORN_API_LIMIT", 100),
+                   limit_per_host=os.environ.get("TORN_API_LIMIT_PER_HOST", 30),
+                   keepalive_timeout=os.environ.get("TORN_API_KEEPALIVE", 60),
+                   timeout=os.environ.get("TORN_API_TIMEOUT", 15),
+                   cache_ttl=json.loads(os.environ.get("TORN_API_CACHE_TTL", "{}")),
+                   rate_limit=os.environ.get("TORN_API_RATE_LIMIT", 90),
+                   rate_burst=os.environ.get("TORN_API_RATE_BURST", 10))
+
+# database connection pool size
+db_pool = (os.environ.get("DB_POOL_MIN_SIZE", 1), os.environ.get("DB_POOL_MAX_SIZE", 10))
+
+# identity cache time to live (verified users, unknown users)
+identity_ttl = (os.environ.get("IDENTITY_TTL", 60), os.environ.get("IDENTITY_NEGATIVE_TTL", 300))
+
+# seconds between two writes of the configuration changes
+config_flush = os.environ.get("CONFIG_FLUSH_INTERVAL", 5)
+
+bot = None
 
 
 def get_prefix(client, message):
@@ -73,34 +111,78 @@ def get_prefix(client, message):
         return "!"
 
 
-# init yata bot
-bot = YataBot(configurations=configurations,
-              command_prefix=get_prefix,
-              bot_id=bot_id,
-              main_server_id=main_server_id,
-              github_token=github_token)
-bot.remove_command('help')
-
-# load classes
-bot.add_cog(Admin(bot))
-
-if int(bot_id) in [1, 3]:
-    bot.add_cog(Verify(bot))
-    bot.add_cog(Loot(bot))
-    bot.add_cog(Stocks(bot))
-    bot.add_cog(Racket(bot))
-    bot.add_cog(Revive(bot))
-    bot.add_cog(Crimes(bot))
-    bot.add_cog(API(bot))
-    bot.add_cog(Chain(bot))
-    bot.add_cog(Misc(bot))
-    bot.add_cog(Repository(bot))
-
-elif int(bot_id) in [2]:
-    bot.add_cog(Marvin(bot))
-
-elif int(bot_id) in [4]:
-    bot.add_cog(Stocks(bot))
-
-# run bot
-bot.run(token)
+def import_cogs(names):
+    """ imports the modules of the cogs
+        return the list of cog classes
+    """
+    return [getattr(importlib.import_module(COGS[name][0]), COGS[name][1]) for name in names]
+
+
+async def main():
+    global bot
+    phases = [("imports", time.monotonic() - started)]
+    t = time.monotonic()
+
+    # import the cogs of this bot only
+    # (in the main thread: the task loops of the cogs get the event loop when they are defined)
+    cogs = ["api"] if notify_worker else ["admin"] + BOT_COGS.get(int(bot_id), [])
+    cog_classes = import_cogs(cogs)
+    phases.append(("cogs import", time.monotonic() - t))
+    t = time.monotonic()
+
+    # open the database pool and the torn api session
+    await asyncio.gather(init_pool(min_size=db_pool[0], max_size=db_pool[1]), torn_api.open())
+    phases.append(("pool", time.monotonic() - t))
+    t = time.monotonic()
+
+    # get configurations from YATA's database
+    token, configurations = await load_configurations(bot_id)
+    phases.append(("configurations", time.monotonic() - t))
+    t = time.monotonic()
+
+    # init yata bot
+    bot = YataBot(configurations=configurations,
+                  command_prefix=get_prefix,
+                  bot_id=bot_id,
+                  main_server_id=main_server_id,
+                  github_token=github_token,
+                  torn_api=torn_api,
+                  db_pool=db_pool,
+                  identity_ttl=identity_ttl,
+                  config_flush=config_flush,
+                  notify_worker=notify_worker)
+    bot.remove_command('help')
+
+    # load classes
+    for cog in cog_classes:
+        bot.add_cog(cog(bot))
+
+    # the commands are answered by the main process only
+    if notify_worker:
+        for command in list(bot.commands):
+            bot.remove_command(command.name)
+    phases.append(("cogs", time.monotonic() - t))
+    logging.info(f'[main] cogs loaded: {", ".join(cogs)}')
+
+    # run bot
+    bot.startup = (started, phases)
+    await bot.start(token)
+
+
+def stop():
+    if bot is not None and not bot.is_closed():
+        asyncio.get_event_loop().create_task(bot.close())
+
+
+loop = asyncio.get_event_loop()
+try:
+    loop.add_signal_handler(signal.SIGTERM, stop)
+except NotImplementedError:
+    pass
+
+try:
+    loop.run_until_complete(main())
+except KeyboardInterrupt:
+    logging.info('[main] interrupted')
+    if bot is not None and not bot.is_closed():
+        loop.run_until_complete(bot.close())